@@ -4,24 +4,128 @@ Daf Yomi Web Application
 Flask web server for downloading and combining Daf Yomi pages
 """
 
-from flask import Flask, render_template, request, jsonify, send_file, Response
-from curl_cffi import requests
 import os
+
+# "threaded" (default) runs on Flask's threaded server. "gevent" turns threads, locks and
+# sockets into cooperative green threads so one process can hold thousands of open
+# progress streams; patching has to happen before anything else is imported.
+SERVER_MODE = os.environ.get('DAF_SERVER', 'threaded')
+if SERVER_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, render_template, request, jsonify, send_file, Response
+from curl_cffi import requests, CurlHttpVersion
 import re
 import tempfile
+import shutil
 import zipfile
+from abc import ABC, abstractmethod
 from pathlib import Path
+from urllib.parse import urlparse
 from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
 from datetime import datetime
 import json
+import sqlite3
+import multiprocessing
+import html as html_lib
 import time
 import uuid
-from threading import Thread
+import hashlib
+import gzip
+import queue
+import random
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Thread, Lock, BoundedSemaphore, Event, Condition, local
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import brotli
+except ImportError:  # optional: without it completed documents are only precompressed with gzip
+    brotli = None
 
 app = Flask(__name__)
 
-# Global dictionary to store progress data
-progress_data = {}
+progress_lock = Lock()
+
+# Where task progress lives: "memory" (this process only) or "sqlite", a database file
+# shared by every worker process on the host, e.g. several gunicorn workers
+TASK_STORE_BACKEND = os.environ.get('DAF_TASK_STORE', 'memory')
+# How often a listener re-reads the shared store for changes made by other processes
+TASK_STORE_POLL_INTERVAL = 0.5
+# How often a process marks the tasks it runs as alive in the shared store, and after
+# how long without a heartbeat another process takes them over
+TASK_HEARTBEAT_INTERVAL = 15
+TASK_ORPHAN_AFTER = 4 * TASK_HEARTBEAT_INTERVAL
+
+# How long a finished task (and its output file) stays downloadable, in seconds
+TASK_RETENTION_SECONDS = int(os.environ.get('DAF_TASK_RETENTION', '3600'))
+task_reaper = None
+task_reaper_lock = Lock()
+
+# Download jobs run on a fixed pool of workers; requests beyond the queue limit are refused
+JOB_WORKERS = max(1, int(os.environ.get('DAF_JOB_WORKERS', '2')))
+JOB_QUEUE_SIZE = max(0, int(os.environ.get('DAF_JOB_QUEUE_SIZE', '20')))
+# ZIP exports stream from the request itself, so they get their own fixed number of slots
+EXPORT_SLOTS = max(1, int(os.environ.get('DAF_EXPORT_SLOTS', str(JOB_WORKERS))))
+
+# Seconds between SSE heartbeat comments while a task's progress is unchanged
+PROGRESS_HEARTBEAT = 15
+
+# Number of amudim fetched concurrently within a single download job
+FETCH_WORKERS = max(1, int(os.environ.get('DAF_FETCH_WORKERS', '4')))
+
+# Politeness towards daf-yomi.com: requests per second and burst size per upstream host,
+# shared by every job in the process
+UPSTREAM_RATE = float(os.environ.get('DAF_UPSTREAM_RATE', '5'))
+UPSTREAM_BURST = max(1, int(os.environ.get('DAF_UPSTREAM_BURST', '2')))
+
+# Adaptive (AIMD) limit on concurrent upstream requests across all jobs: bounds, and
+# the response time in seconds that counts as a latency spike
+UPSTREAM_MIN_CONCURRENCY = max(1, int(os.environ.get('DAF_UPSTREAM_MIN_CONCURRENCY', '1')))
+UPSTREAM_MAX_CONCURRENCY = max(UPSTREAM_MIN_CONCURRENCY, int(os.environ.get('DAF_UPSTREAM_MAX_CONCURRENCY', '16')))
+UPSTREAM_LATENCY_THRESHOLD = float(os.environ.get('DAF_UPSTREAM_LATENCY_THRESHOLD', '5'))
+OVERLOAD_STATUS_CODES = {429, 503}
+CHALLENGE_MARKERS = ('cf-chl-', 'challenge-platform', '<title>Just a moment...</title>')
+
+# Persistent curl_cffi sessions kept alive and reused across pages and jobs
+SESSION_POOL_SIZE = max(1, int(os.environ.get('DAF_SESSION_POOL_SIZE', str(UPSTREAM_MAX_CONCURRENCY))))
+
+# On-disk cache of raw daf-yomi.com pages: freshness window and disk budget
+CACHE_DIR = os.environ.get('DAF_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+PAGE_CACHE_TTL = int(os.environ.get('DAF_PAGE_CACHE_TTL', str(7 * 24 * 3600)))
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('DAF_PAGE_CACHE_MAX_MB', '200')) * 1024 * 1024
+# Cache of extracted, cleaned fragments keyed by raw content hash
+FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('DAF_FRAGMENT_CACHE_MAX_MB', '100')) * 1024 * 1024
+# Bump whenever extraction, sanitizing or fragment cleanup changes its output,
+# so fragments cached by older code are no longer used
+EXTRACTOR_VERSION = '1'
+# Cache of finished combined documents: disk budget and how long one is reused
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('DAF_RESULT_CACHE_MAX_MB', '500')) * 1024 * 1024
+RESULT_CACHE_TTL = int(os.environ.get('DAF_RESULT_CACHE_TTL', str(PAGE_CACHE_TTL)))
+# Bump whenever the layout of the combined document changes
+OUTPUT_FORMAT_VERSION = '1'
+
+# Upstream circuit breaker: consecutive failures before tripping, and seconds to stay open
+BREAKER_THRESHOLD = max(1, int(os.environ.get('DAF_BREAKER_THRESHOLD', '5')))
+BREAKER_COOLDOWN = float(os.environ.get('DAF_BREAKER_COOLDOWN', '60'))
+# Seconds a page that returned 404 or failed extraction is not requested again
+NEGATIVE_CACHE_TTL = float(os.environ.get('DAF_NEGATIVE_CACHE_TTL', '300'))
+
+# Retries for transient upstream errors: attempts after the first, and backoff bounds in seconds
+FETCH_RETRIES = max(0, int(os.environ.get('DAF_FETCH_RETRIES', '3')))
+RETRY_BACKOFF_BASE = float(os.environ.get('DAF_RETRY_BACKOFF_BASE', '0.5'))
+RETRY_BACKOFF_MAX = float(os.environ.get('DAF_RETRY_BACKOFF_MAX', '8'))
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# Overall time budget for one download job, in seconds
+JOB_DEADLINE = float(os.environ.get('DAF_JOB_DEADLINE', '600'))
+# An unfinished task older than this cannot still be running: its job has waited out
+# a full queue and used up its deadline. Such tasks are dropped, never joined.
+STALE_TASK_AGE = JOB_DEADLINE * (1 + -(-JOB_QUEUE_SIZE // JOB_WORKERS)) + 60
+UPSTREAM_TIMEOUT = 30
 
 # Hebrew number mappings
 HEBREW_NUMBERS = {
@@ -130,6 +234,23 @@ TRACTATES = {
     'נדה': 322            # Following sequence pattern (was נידה on site)
 }
 
+# Reverse mapping from site massechet number to tractate name
+MASSECHET_NAMES = {v: k for k, v in TRACTATES.items()}
+
+# Previously downloaded pages used as a fallback when the site is unreachable
+PAGES_DIR = "pages"
+
+# BeautifulSoup tree builder used for extraction. "html.parser" is the pure-Python
+# reference implementation; "lxml" is C-backed and several times faster on the heavy
+# ASP.NET pages. "auto" picks lxml when it is installed.
+REFERENCE_HTML_PARSER = 'html.parser'
+HTML_PARSER_SETTING = os.environ.get('DAF_HTML_PARSER', 'auto')
+# When set, every extraction is repeated with the reference parser and differences are logged
+PARSER_PARITY_CHECK = os.environ.get('DAF_PARSER_PARITY_CHECK', '') not in ('', '0')
+# Processes used for parsing so extraction isn't limited to the one core holding the GIL
+# (0 parses in the calling thread)
+PARSE_WORKERS = max(0, int(os.environ.get('DAF_PARSE_WORKERS', '0')))
+
 def hebrew_to_amud_number(daf_hebrew, amud):
     """Convert Hebrew daf notation to amud number used by the site"""
     page_num = HEBREW_NUMBERS.get(daf_hebrew, 0)
@@ -141,6 +262,489 @@ def hebrew_to_amud_number(daf_hebrew, amud):
     else:  # ב
         return (page_num - 1) * 2 + 2
 
+def iter_amudim(start_num, start_amud, end_num, end_amud):
+    """Yield (daf_num, amud) pairs for the requested range in reading order"""
+    for daf_num in range(start_num, end_num + 1):
+        for amud in ['א', 'ב']:
+            # Skip if we're at start daf and before start amud
+            if daf_num == start_num and start_amud == 'ב' and amud == 'א':
+                continue
+            # Skip if we're at end daf and after end amud
+            if daf_num == end_num and end_amud == 'א' and amud == 'ב':
+                continue
+            yield daf_num, amud
+
+def run_blocking(fn, *args, **kwargs):
+    """Call fn, on a real OS thread in gevent mode.
+
+    For work gevent cannot make cooperative: libcurl calls inside curl_cffi and
+    CPU-heavy parsing would otherwise stall every green thread in the process.
+    """
+    if SERVER_MODE != 'gevent':
+        return fn(*args, **kwargs)
+    import gevent
+
+    def call():
+        # Hand exceptions back instead of letting the pool print them as crashes
+        try:
+            return fn(*args, **kwargs), None
+        except Exception as e:
+            return None, e
+
+    result, error = gevent.get_hub().threadpool.apply(call)
+    if error is not None:
+        raise error
+    return result
+
+process_owner = (None, None)  # (pid, token)
+
+def process_token():
+    """Identifier of this process's lifetime, unlike a pid never reused after a restart"""
+    global process_owner
+    pid, token = process_owner
+    if pid != os.getpid():
+        # First call, or a worker forked from a process that already had a token
+        process_owner = pid, token = os.getpid(), uuid.uuid4().hex
+    return token
+
+class TaskStore(ABC):
+    """Where task progress (status, progress, result location) is kept.
+
+    Each task is a dict of progress fields plus a version that increases on every
+    change, the process running it and the parameters of its job.
+    Listeners in this process are woken through per-task conditions, which exist
+    only while someone is waiting on the task.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.conditions = {}  # task_id -> [condition, number of waiters]
+
+    @contextmanager
+    def _waiting(self, task_id):
+        """Condition to wait on for task_id, dropped when its last waiter leaves. Caller holds self.lock"""
+        entry = self.conditions.get(task_id)
+        if entry is None:
+            entry = self.conditions[task_id] = [Condition(self.lock), 0]
+        entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self.conditions.get(task_id) is entry:
+                del self.conditions[task_id]
+
+    def _notify_locked(self, task_id):
+        entry = self.conditions.get(task_id)
+        if entry is not None:
+            entry[0].notify_all()
+
+    def _notify(self, task_id):
+        with self.lock:
+            self._notify_locked(task_id)
+
+    @abstractmethod
+    def create_or_join(self, task_id, fields, job, job_key):
+        """Create the task unless an identical job (same job_key) is running or recently done.
+
+        Returns (task_id that will produce the result, whether it was newly created).
+        """
+
+    @staticmethod
+    def stale(data, now):
+        """Unfinished, yet too old for its job to still be running"""
+        return data.get('finished_at') is None and now - data.get('started_at', 0) > STALE_TASK_AGE
+
+    @classmethod
+    def joinable(cls, data):
+        # Failed or partial results are worth a fresh attempt rather than sharing
+        if data.get('status') == 'error' or cls.stale(data, time.time()):
+            return False
+        return not (data.get('status') == 'completed' and data.get('missing_pages'))
+
+    def get(self, task_id):
+        """Copy of a task's progress fields, or None"""
+        return self.read(task_id)[0]
+
+    @abstractmethod
+    def read(self, task_id):
+        """(copy of progress fields or None, version)"""
+
+    @abstractmethod
+    def update(self, task_id, fields):
+        """Merge fields into a task's progress and wake its listeners"""
+
+    @abstractmethod
+    def wait(self, task_id, seen_version, timeout):
+        """Block until the task changes from seen_version, or timeout; returns read()"""
+
+    @abstractmethod
+    def expire(self, cutoff):
+        """Remove tasks that finished before cutoff, or are stale, and return their progress fields"""
+
+    def heartbeat(self):
+        """Mark the unfinished tasks this process runs as still alive"""
+
+    def claim_orphans(self):
+        """Take over unfinished tasks whose owner stopped sending heartbeats; returns [(task_id, job)]"""
+        return []
+
+class MemoryTaskStore(TaskStore):
+    """Tasks in a dict of this process; the default for a single server process"""
+
+    def __init__(self):
+        super().__init__()
+        self.tasks = {}  # task_id -> (fields, version)
+        self.job_keys = {}  # job_key -> task_id of its latest job
+
+    def create_or_join(self, task_id, fields, job, job_key):
+        with self.lock:
+            existing = self.job_keys.get(job_key)
+            if existing in self.tasks and self.joinable(self.tasks[existing][0]):
+                return existing, False
+            self.tasks[task_id] = (dict(fields), 0)
+            self.job_keys[job_key] = task_id
+            return task_id, True
+
+    def read(self, task_id):
+        with self.lock:
+            if task_id not in self.tasks:
+                return None, 0
+            data, version = self.tasks[task_id]
+            return dict(data), version
+
+    def update(self, task_id, fields):
+        with self.lock:
+            if task_id not in self.tasks:
+                return
+            data, version = self.tasks[task_id]
+            if all(k in data and data[k] == v for k, v in fields.items()):
+                return
+            data.update(fields)
+            self.tasks[task_id] = (data, version + 1)
+            self._notify_locked(task_id)
+
+    def _forget_job_key(self, task_id):
+        # Caller holds self.lock
+        for job_key in [k for k, v in self.job_keys.items() if v == task_id]:
+            del self.job_keys[job_key]
+
+    def wait(self, task_id, seen_version, timeout):
+        with self.lock:
+            # Unknown tasks return at once, so bogus ids never register a condition
+            if task_id in self.tasks and self.tasks[task_id][1] == seen_version:
+                with self._waiting(task_id) as condition:
+                    condition.wait_for(
+                        lambda: task_id not in self.tasks or self.tasks[task_id][1] != seen_version,
+                        timeout
+                    )
+        return self.read(task_id)
+
+    def expire(self, cutoff):
+        with self.lock:
+            now = time.time()
+            expired = [task_id for task_id, (data, _) in self.tasks.items()
+                       if data.get('finished_at', cutoff) < cutoff or self.stale(data, now)]
+            reaped = [self.tasks.pop(task_id)[0] for task_id in expired]
+            for task_id in expired:
+                self._forget_job_key(task_id)
+        for task_id in expired:
+            self._notify(task_id)
+        return reaped
+
+class SqliteTaskStore(TaskStore):
+    """Tasks in a SQLite database shared by all worker processes on the host.
+
+    Any process can answer progress and download requests for any task. Listeners
+    are woken at once for changes made in their own process and see changes from
+    other processes within TASK_STORE_POLL_INTERVAL. Every process refreshes the
+    heartbeat of the tasks it owns; unfinished tasks whose heartbeat is older than
+    TASK_ORPHAN_AFTER belong to a process that died and are re-run by whichever
+    process notices first.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.local = local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            job TEXT,
+            finished_at REAL
+        )""")
+        for column in ('job_key TEXT', 'owner TEXT', 'heartbeat_at REAL'):
+            try:
+                db.execute(f'ALTER TABLE tasks ADD COLUMN {column}')
+            except sqlite3.OperationalError:
+                pass  # already there
+        db.execute('CREATE INDEX IF NOT EXISTS tasks_job_key ON tasks (job_key)')
+
+    def _db(self):
+        # One connection per thread; autocommit, with explicit transactions where needed
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def create_or_join(self, task_id, fields, job, job_key):
+        with self._transaction() as db:
+            rows = db.execute('SELECT task_id, data FROM tasks WHERE job_key = ? ORDER BY rowid DESC',
+                              (job_key,)).fetchall()
+            for existing, data in rows:
+                if self.joinable(json.loads(data)):
+                    return existing, False
+            db.execute(
+                'INSERT INTO tasks (task_id, data, version, owner, heartbeat_at, job, job_key) '
+                'VALUES (?, ?, 0, ?, ?, ?, ?)',
+                (task_id, json.dumps(fields), process_token(), time.time(), json.dumps(job), job_key)
+            )
+        return task_id, True
+
+    def read(self, task_id):
+        row = self._db().execute('SELECT data, version FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None:
+            return None, 0
+        return json.loads(row[0]), row[1]
+
+    def update(self, task_id, fields):
+        with self._transaction() as db:
+            row = db.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                return
+            data = json.loads(row[0])
+            if all(k in data and data[k] == v for k, v in fields.items()):
+                return
+            data.update(fields)
+            db.execute('UPDATE tasks SET data = ?, version = version + 1, finished_at = ? WHERE task_id = ?',
+                       (json.dumps(data), data.get('finished_at'), task_id))
+        self._notify(task_id)
+
+    def wait(self, task_id, seen_version, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            data, version = self.read(task_id)
+            remaining = deadline - time.monotonic()
+            if data is None or version != seen_version or remaining <= 0:
+                return data, version
+            with self.lock, self._waiting(task_id) as condition:
+                condition.wait(min(remaining, TASK_STORE_POLL_INTERVAL))
+
+    def expire(self, cutoff):
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute('SELECT task_id, data FROM tasks WHERE finished_at < ?', (cutoff,)).fetchall()
+            rows += [(task_id, data) for task_id, data in
+                     db.execute('SELECT task_id, data FROM tasks WHERE finished_at IS NULL').fetchall()
+                     if self.stale(json.loads(data), now)]
+            db.executemany('DELETE FROM tasks WHERE task_id = ?', [(task_id,) for task_id, _ in rows])
+        for task_id, _ in rows:
+            self._notify(task_id)
+        return [json.loads(data) for _, data in rows]
+
+    def heartbeat(self):
+        self._db().execute('UPDATE tasks SET heartbeat_at = ? WHERE owner = ? AND finished_at IS NULL',
+                           (time.time(), process_token()))
+
+    def claim_orphans(self):
+        claimed = []
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute(
+                'SELECT task_id, data, job FROM tasks WHERE finished_at IS NULL AND job IS NOT NULL '
+                'AND (heartbeat_at IS NULL OR heartbeat_at < ?) AND (owner IS NULL OR owner != ?)',
+                (now - TASK_ORPHAN_AFTER, process_token())
+            ).fetchall()
+            for task_id, data, job in rows:
+                # The job starts over, so its age does too
+                data = json.loads(data)
+                data['started_at'] = now
+                db.execute('UPDATE tasks SET owner = ?, heartbeat_at = ?, data = ?, version = version + 1 '
+                           'WHERE task_id = ?', (process_token(), now, json.dumps(data), task_id))
+                claimed.append((task_id, json.loads(job)))
+        return claimed
+
+def create_task_store(backend):
+    if backend == 'memory':
+        return MemoryTaskStore()
+    if backend == 'sqlite':
+        return SqliteTaskStore(os.environ.get('DAF_TASK_DB', os.path.join(CACHE_DIR, 'tasks.sqlite3')))
+    raise ValueError(f"Unknown DAF_TASK_STORE: {backend}")
+
+task_store = create_task_store(TASK_STORE_BACKEND)
+
+def update_progress(task_id, **fields):
+    """Thread-safe update of a task's progress entry; wakes its listeners if anything changed"""
+    if fields.get('status') in ('completed', 'error'):
+        fields.setdefault('finished_at', time.time())
+    task_store.update(task_id, fields)
+
+def wait_for_progress(task_id, seen_version, timeout):
+    """Wait until a task's progress differs from seen_version, or timeout.
+
+    Returns (copy of the progress entry, its version); the entry is None once the
+    task is gone. Pass seen_version=None to get the current state immediately.
+    """
+    return task_store.wait(task_id, seen_version, timeout)
+
+def resume_orphaned_tasks():
+    """Re-queue jobs left unfinished by a worker process that has died"""
+    for task_id, job in task_store.claim_orphans():
+        print(f"DEBUG: Resuming orphaned task {task_id}")
+        if not job_scheduler.submit(task_id, download_pages_background, *job):
+            update_progress(task_id, status='error', message='השרת עמוס, נסה שוב מאוחר יותר')
+
+def reap_finished_tasks():
+    """Keep this process's tasks alive, take over orphaned ones, and forget finished
+    tasks after TASK_RETENTION_SECONDS, deleting their output"""
+    while True:
+        task_store.heartbeat()
+        resume_orphaned_tasks()
+        time.sleep(max(1, min(TASK_HEARTBEAT_INTERVAL, TASK_RETENTION_SECONDS)))
+        for data in task_store.expire(time.time() - TASK_RETENTION_SECONDS):
+            temp_dir = data.get('temp_dir')
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                print(f"DEBUG: Cleaned up temp dir: {temp_dir}")
+
+def ensure_task_reaper():
+    """Start the background thread that resumes orphaned and expires finished tasks, once"""
+    global task_reaper
+    with task_reaper_lock:
+        if task_reaper is None:
+            task_reaper = Thread(target=reap_finished_tasks, daemon=True)
+            task_reaper.start()
+
+class JobScheduler:
+    """Fixed pool of job workers fed from a bounded FIFO queue.
+
+    Tasks waiting in the queue get status 'queued' with their queue_position and
+    an estimated_wait (seconds) based on how long recent jobs took.
+    """
+
+    def __init__(self, workers, max_queued):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.cond = Condition()
+        self.waiting = deque()  # (task_id, fn, args)
+        self.running = 0
+        self.durations = deque(maxlen=20)
+        self.threads = []
+
+    def _average_duration(self):
+        # Until a job has finished, assume a typical short range
+        return sum(self.durations) / len(self.durations) if self.durations else 30.0
+
+    def retry_after(self):
+        """Seconds until a queue slot is likely to free up"""
+        with self.cond:
+            return max(1, int(self._average_duration() / self.workers))
+
+    def _publish_positions(self):
+        average = self._average_duration()
+        for index, (task_id, _, _) in enumerate(self.waiting):
+            position = index + 1
+            update_progress(task_id,
+                status='queued',
+                queue_position=position,
+                estimated_wait=int(average * ((index + self.running) // self.workers)),
+                message=f'ממתין בתור (מקום {position})...'
+            )
+
+    def submit(self, task_id, fn, *args):
+        """Queue a job; returns False when the queue is full"""
+        with self.cond:
+            if not self.threads:
+                for _ in range(self.workers):
+                    thread = Thread(target=self._work, daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+            # Idle workers take jobs straight away, so they don't count against the queue
+            if len(self.waiting) >= self.max_queued + self.workers - self.running:
+                return False
+            self.waiting.append((task_id, fn, args))
+            self._publish_positions()
+            self.cond.notify()
+            return True
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.waiting:
+                    self.cond.wait()
+                task_id, fn, args = self.waiting.popleft()
+                self.running += 1
+                self._publish_positions()
+            update_progress(task_id,
+                status='starting',
+                queue_position=0,
+                estimated_wait=0,
+                message='מתחיל הורדה...'
+            )
+            started = time.monotonic()
+            try:
+                fn(task_id, *args)
+            except Exception as e:
+                print(f"ERROR: Job {task_id} failed: {e}")
+            finally:
+                with self.cond:
+                    self.running -= 1
+                    self.durations.append(time.monotonic() - started)
+                    self._publish_positions()
+
+    def snapshot(self):
+        with self.cond:
+            return {'workers': self.workers, 'running': self.running,
+                    'queued': len(self.waiting), 'max_queued': self.max_queued}
+
+job_scheduler = JobScheduler(JOB_WORKERS, JOB_QUEUE_SIZE)
+
+class ExportSlots:
+    """Fixed number of ZIP exports that may stream at once, with no queue behind them"""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.lock = Lock()
+        self.running = 0
+        self.durations = deque(maxlen=20)
+
+    def acquire(self):
+        """Take a slot; returns its start time, or None when all slots are busy"""
+        with self.lock:
+            if self.running >= self.slots:
+                return None
+            self.running += 1
+            return time.monotonic()
+
+    def release(self, started):
+        with self.lock:
+            self.running -= 1
+            self.durations.append(time.monotonic() - started)
+
+    def retry_after(self):
+        """Seconds until an export slot is likely to free up"""
+        with self.lock:
+            # Until an export has finished, assume a typical short range
+            average = sum(self.durations) / len(self.durations) if self.durations else 30.0
+            return max(1, int(average / self.slots))
+
+export_slots = ExportSlots(EXPORT_SLOTS)
+
 def create_informative_filename(tractate_name, start_daf, start_amud, end_daf, end_amud):
     """
     Create informative filename following pattern:
@@ -169,22 +773,568 @@ def create_informative_filename(tractate_name, start_daf, start_amud, end_daf, e
     # Handle different dafim - use page range
     return f"{english_name}_{start_num}-{end_num}.html"
 
-def download_daf_page(massechet_num, amud_num):
-    """Download a single daf page using curl_cffi with browser impersonation"""
-    url = f"https://daf-yomi.com/Dafyomi_Page.aspx?vt=5&massechet={massechet_num}&amud={amud_num}&fs=0"
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a request may be sent"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
+rate_limiters = {}
+rate_limiters_lock = Lock()
+
+def get_rate_limiter(url):
+    """Return the process-wide token bucket for the URL's host"""
+    host = urlparse(url).hostname or ''
+    with rate_limiters_lock:
+        limiter = rate_limiters.get(host)
+        if limiter is None:
+            limiter = rate_limiters[host] = TokenBucket(UPSTREAM_RATE, UPSTREAM_BURST)
+        return limiter
+
+class SessionPool:
+    """Thread-safe pool of long-lived curl_cffi sessions.
+
+    Each session keeps its connections (and TLS/HTTP2 state) alive, so only the
+    first request on a session pays for the handshake. A session is used by one
+    thread at a time and is dropped if a request on it raises.
+    """
+
+    def __init__(self, size):
+        self.idle = queue.LifoQueue()
+        self.slots = BoundedSemaphore(size)
+
+    def _new_session(self):
+        # Chrome 120 impersonation (bypasses Cloudflare), HTTP/2 when the server offers it
+        return requests.Session(
+            impersonate='chrome120',
+            http_version=CurlHttpVersion.V2TLS,
+            use_thread_local_curl=False,
+        )
+
+    @contextmanager
+    def session(self):
+        with self.slots:
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                session = self._new_session()
+            try:
+                yield session
+            except Exception:
+                session.close()
+                raise
+            self.idle.put(session)
+
+session_pool = SessionPool(SESSION_POOL_SIZE)
+
+class AdaptiveLimiter:
+    """AIMD limit on concurrent upstream requests.
+
+    Every fast, successful response raises the limit by 1/limit (about +1 per
+    round trip of the whole window); a 429/503, challenge page, connection error
+    or latency spike halves it. Responses to requests started before the last
+    cut are ignored, so one overload burst only halves the limit once.
+    """
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.cond = Condition()
+
+    def acquire(self, timeout=None):
+        """Wait for a slot; return a ticket for release(), or None on timeout"""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, ticket, overloaded):
+        with self.cond:
+            self.in_flight -= 1
+            if overloaded:
+                if ticket >= self.last_decrease:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = time.monotonic()
+                    print(f"DEBUG: Upstream overloaded, concurrency limit now {int(self.limit)}")
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            return {'concurrency_limit': int(self.limit), 'in_flight': self.in_flight}
+
+upstream_limiter = AdaptiveLimiter(FETCH_WORKERS, UPSTREAM_MIN_CONCURRENCY, UPSTREAM_MAX_CONCURRENCY)
+
+def is_challenge_page(response):
+    """Detect a Cloudflare challenge/interstitial instead of real content"""
+    if response.headers.get('cf-mitigated') == 'challenge':
+        return True
+    if response.status_code in (403, 503):
+        return any(marker in response.text for marker in CHALLENGE_MARKERS)
+    return False
+
+class DiskCache:
+    """Size-bounded LRU cache of text entries stored in a directory.
+
+    Every entry is a `<key>.body` file plus a `<key>.json` metadata file. The
+    body's mtime records the last access, so recency survives restarts; once the
+    bodies exceed max_bytes the least recently used entries are deleted.
+
+    The in-memory index is per process. With several worker processes sharing the
+    directory, a miss in the index falls back to the disk, so entries written by
+    other workers are found (and adopted into this worker's index). Each worker
+    enforces max_bytes against the entries it knows about.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key -> body size, least recently used first
+        self.total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for name in os.listdir(directory):
+            if name.endswith('.body'):
+                st = os.stat(os.path.join(directory, name))
+                found.append((st.st_mtime, name[:-len('.body')], st.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _touch(self, key):
+        """Mark key as recently used; False if there is no such entry in the index or on disk"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True
+        try:
+            size = os.stat(self._path(key, '.body')).st_size
+        except OSError:
+            return False
+        # Written by another worker process since this index was built
+        self._adopt(key, size)
+        return True
+
+    def _adopt(self, key, size):
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+
+    def get(self, key):
+        """Return (body, meta) and mark the entry as recently used, or None"""
+        if not self._touch(key):
+            return None
+        try:
+            with open(self._path(key, '.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(self._path(key, '.body'), 'r', encoding='utf-8') as f:
+                body = f.read()
+            os.utime(self._path(key, '.body'))
+        except (OSError, ValueError):
+            self.remove(key)
+            return None
+        return body, meta
+
+    def get_path(self, key):
+        """Like get(), but return the path of the body file instead of its contents"""
+        if not self._touch(key):
+            return None
+        body_path = self._path(key, '.body')
+        try:
+            with open(self._path(key, '.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(body_path)
+        except (OSError, ValueError):
+            self.remove(key)
+            return None
+        return body_path, meta
+
+    def put(self, key, body, meta):
+        self._write(self._path(key, '.body'), body)
+        self._stored(key, meta)
+
+    def put_file(self, key, src_path, meta):
+        """Store a copy of an existing file as the entry's body"""
+        body_path = self._path(key, '.body')
+        tmp_path = f"{body_path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, body_path)
+        self._stored(key, meta)
+
+    def _stored(self, key, meta):
+        self._write(self._path(key, '.json'), json.dumps(meta))
+        size = os.path.getsize(self._path(key, '.body'))
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+        self._evict()
+
+    def update_meta(self, key, meta):
+        self._write(self._path(key, '.json'), json.dumps(meta))
+
+    def remove(self, key):
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+        self._unlink(key)
+
+    def _unlink(self, key):
+        for suffix in ('.body', '.json'):
+            try:
+                os.remove(self._path(key, suffix))
+            except OSError:
+                pass
+
+    def _evict(self):
+        while True:
+            with self.lock:
+                if self.total_bytes <= self.max_bytes or len(self.entries) <= 1:
+                    return
+                key, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+            print(f"DEBUG: Evicting cache entry {key} from {self.directory}")
+            self._unlink(key)
+
+page_cache = DiskCache(os.path.join(CACHE_DIR, 'pages'), PAGE_CACHE_MAX_BYTES)
+
+class ResultCache(DiskCache):
+    """DiskCache of finished combined documents that also knows which amudim each one contains.
+
+    Entry metadata lists the page cache keys of its amudim; when one of those pages
+    comes back from the site with different content, every document built from it
+    is dropped. With several worker processes, a worker only drops the documents
+    it knows about; others still expire after RESULT_CACHE_TTL.
+    """
+
+    def __init__(self, directory, max_bytes):
+        super().__init__(directory, max_bytes)
+        self.by_amud = {}
+        for key in list(self.entries):
+            try:
+                with open(self._path(key, '.json'), 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                self.remove(key)
+                continue
+            self._index(key, meta)
+
+    def _index(self, key, meta):
+        with self.lock:
+            for amud_key in meta.get('amudim', []):
+                self.by_amud.setdefault(amud_key, set()).add(key)
+
+    def _adopt(self, key, size):
+        super()._adopt(key, size)
+        try:
+            with open(self._path(key, '.json'), 'r', encoding='utf-8') as f:
+                self._index(key, json.load(f))
+        except (OSError, ValueError):
+            pass  # get_path() drops the entry when it can't read the metadata
+
+    def put_file(self, key, src_path, meta):
+        # Precompressed variants of the document travel with it
+        body_path = self._path(key, '.body')
+        for _, suffix, _ in DOCUMENT_ENCODINGS:
+            if os.path.exists(src_path + suffix):
+                shutil.copyfile(src_path + suffix, body_path + suffix)
+        super().put_file(key, src_path, meta)
+        self._index(key, meta)
+
+    def _unlink(self, key):
+        super()._unlink(key)
+        for _, suffix, _ in DOCUMENT_ENCODINGS:
+            try:
+                os.remove(self._path(key, '.body' + suffix))
+            except OSError:
+                pass
+
+    def link_out(self, body_path, dest_path):
+        """Give dest_path its own hard link (or copy) of an entry's body and encoded variants.
+
+        The task keeps its file even if the entry is later evicted or invalidated.
+        Returns False when the entry disappeared in the meantime.
+        """
+        try:
+            for suffix in [''] + [suffix for _, suffix, _ in DOCUMENT_ENCODINGS]:
+                src_path = body_path + suffix
+                if suffix and not os.path.exists(src_path):
+                    continue
+                try:
+                    os.link(src_path, dest_path + suffix)
+                except FileNotFoundError:
+                    raise
+                except OSError:
+                    # e.g. the cache is on another filesystem than the temp dir
+                    shutil.copyfile(src_path, dest_path + suffix)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def invalidate_amud(self, amud_key):
+        with self.lock:
+            keys = self.by_amud.pop(amud_key, set())
+        for key in keys:
+            if key in self.entries:
+                print(f"DEBUG: Page {amud_key} changed, dropping cached result {key}")
+            self.remove(key)
+
+# Compression levels for precompressed documents: most of the size win of the
+# maximum settings at a fraction of the CPU time
+DOCUMENT_GZIP_LEVEL = 6
+DOCUMENT_BROTLI_QUALITY = 5
+
+class BrotliWriter:
+    """Minimal writable that brotli-compresses into another file, like gzip.GzipFile"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.compressor = brotli.Compressor(quality=DOCUMENT_BROTLI_QUALITY)
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.process(data))
+
+    def close(self):
+        self.fileobj.write(self.compressor.finish())
+
+# Content-Encodings completed documents are stored in, most preferred first:
+# (encoding, file suffix, function wrapping an output file in a compressing writer)
+DOCUMENT_ENCODINGS = [('gzip', '.gz', lambda f: gzip.GzipFile(fileobj=f, mode='wb',
+                                                             compresslevel=DOCUMENT_GZIP_LEVEL, mtime=0))]
+if brotli is not None:
+    DOCUMENT_ENCODINGS.insert(0, ('br', '.br', BrotliWriter))
+
+def precompress_document(path):
+    """Write the encoded variants of a finished document next to it and return its ETag.
+
+    The document is read in chunks and fed to every encoder at once, so memory
+    stays bounded however long the document is.
+    """
+    digest = hashlib.sha256()
+    outputs = []
     try:
-        print(f"Attempting real download: {url}")
-        # Add small delay to be respectful
-        time.sleep(0.2)
-
-        # Use curl_cffi with Chrome 120 impersonation (bypasses Cloudflare)
-        response = requests.get(url, impersonate='chrome120', timeout=30)
-        response.raise_for_status()
-        print(f"SUCCESS: Downloaded {len(response.text)} characters from real site")
-        return response.text
-    except Exception as e:
-        print(f"Real download failed: {e}")
+        for _, suffix, open_writer in DOCUMENT_ENCODINGS:
+            tmp_path = f"{path}{suffix}.{uuid.uuid4().hex}.tmp"
+            out = open(tmp_path, 'wb')
+            outputs.append((out, open_writer(out), tmp_path, path + suffix))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(256 * 1024), b''):
+                digest.update(chunk)
+                for _, writer, _, _ in outputs:
+                    writer.write(chunk)
+        for out, writer, tmp_path, final_path in outputs:
+            writer.close()
+            out.close()
+            os.replace(tmp_path, final_path)
+    finally:
+        for out, _, tmp_path, _ in outputs:
+            out.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return digest.hexdigest()[:32]
+
+result_cache = ResultCache(os.path.join(CACHE_DIR, 'results'), RESULT_CACHE_MAX_BYTES)
+
+class CircuitBreaker:
+    """Stops calling the upstream after repeated failures.
+
+    After `threshold` consecutive failures the breaker opens and allow() returns
+    False for `cooldown` seconds. It then lets a single trial request through:
+    success closes the breaker again, failure re-opens it for another cooldown.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def abort_trial(self):
+        """Give back a half-open trial from allow() when no request was made after all"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.threshold:
+                if self.opened_at is None or self.trial_in_flight:
+                    print(f"WARNING: Upstream circuit breaker opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+
+class NegativeCache:
+    """Thread-safe set of keys that expire `ttl` seconds after being added"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.expires = {}
+
+    def add(self, key):
+        with self.lock:
+            self.expires[key] = time.monotonic() + self.ttl
+
+    def __contains__(self, key):
+        with self.lock:
+            expires_at = self.expires.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self.expires[key]
+                return False
+            return True
+
+upstream_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+# Amudim that recently returned 404 or could not be extracted
+failed_pages = NegativeCache(NEGATIVE_CACHE_TTL)
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into a single execution.
+
+    The first caller runs the function; callers arriving while it is in flight
+    wait for it and receive the same result (or exception). do() returns
+    (result, joined), where joined is the Call of the caller whose run was
+    shared, or None for the caller that ran it. The Call records the deadline
+    that run was given, so a joiner can tell whether it gave up sooner than the
+    joiner would have.
+    """
+
+    class Call:
+        def __init__(self, deadline):
+            self.done = Event()
+            self.deadline = deadline
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args, deadline=None):
+        """Run fn(*args, deadline=deadline), or join the run already in flight for key"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call(deadline)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, call
+
+        try:
+            call.result = fn(*args, deadline=deadline)
+            return call.result, None
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+page_flight = SingleFlight()
+
+def gave_up_sooner(call, deadline):
+    """Whether a shared run ran out of a deadline earlier than ours (None is no deadline)"""
+    if call.deadline is None or time.monotonic() < call.deadline:
+        return False
+    return deadline is None or call.deadline < deadline
+
+def download_daf_page(massechet_num, amud_num, deadline=None):
+    """Download a single daf page using curl_cffi with browser impersonation.
+
+    Concurrent requests for the same amud share one upstream fetch. `deadline`
+    is a time.monotonic() value after which no further attempts are made.
+    """
+    key = (massechet_num, amud_num)
+    content, joined = page_flight.do(key, _download_daf_page, massechet_num, amud_num, deadline=deadline)
+    # A shared fetch that failed for its own reasons (403, negative cache, retries
+    # used up) failed for us too. Only one that ran out of an earlier deadline than
+    # ours is worth another go, and that go is shared with the other joiners.
+    while (content is None and joined is not None and gave_up_sooner(joined, deadline)
+           and (deadline is None or time.monotonic() < deadline)):
+        print(f"DEBUG: Shared fetch of {massechet_num}_{amud_num} ran out of an earlier deadline, retrying")
+        content, joined = page_flight.do(key, _download_daf_page, massechet_num, amud_num, deadline=deadline)
+    return content
+
+def retry_delay(attempt):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+def _download_daf_page(massechet_num, amud_num, deadline=None):
+    url = f"https://daf-yomi.com/Dafyomi_Page.aspx?vt=5&massechet={massechet_num}&amud={amud_num}&fs=0"
+    cache_key = f"{massechet_num}_{amud_num}"
+
+    def fallback(stale_body=None):
+        # A stale copy is still better than the local fallback
+        if stale_body:
+            print(f"Using stale cached copy")
+            return stale_body
 
         # Try local files as fallback for tractates we have
         local_content = try_load_existing_page(massechet_num, amud_num)
@@ -195,15 +1345,163 @@ def download_daf_page(massechet_num, amud_num):
         print(f"No local fallback available")
         return None
 
+    def time_left():
+        return float('inf') if deadline is None else deadline - time.monotonic()
+
+    if cache_key in failed_pages:
+        print(f"Recently failed, skipping upstream: {url}")
+        return fallback()
+
+    cached = page_cache.get(cache_key)
+    body = None
+    if cached:
+        body, meta = cached
+        if time.time() - meta.get('fetched_at', 0) < PAGE_CACHE_TTL:
+            print(f"Cache hit: {url}")
+            return body
+
+    # Revalidate stale entries with a conditional request
+    headers = {}
+    if cached:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    for attempt in range(FETCH_RETRIES + 1):
+        # Check the deadline first: allow() may hand this request the half-open trial,
+        # which has to end in record_success() or record_failure()
+        if time_left() <= 0:
+            print(f"Job deadline passed, skipping upstream: {url}")
+            return fallback(body)
+        if not upstream_breaker.allow():
+            print(f"Circuit open, skipping upstream: {url}")
+            return fallback(body)
+
+        print(f"Attempting real download (attempt {attempt + 1}): {url}")
+        # Be respectful: all jobs share one request budget per host
+        get_rate_limiter(url).acquire()
+
+        ticket = upstream_limiter.acquire(timeout=time_left() if deadline is not None else None)
+        if ticket is None:
+            print(f"Job deadline passed waiting for an upstream slot: {url}")
+            upstream_breaker.abort_trial()
+            return fallback(body)
+
+        response = None
+        challenged = False
+        overloaded = True
+        try:
+            with session_pool.session() as session:
+                response = run_blocking(session.get, url, headers=headers,
+                                        timeout=min(UPSTREAM_TIMEOUT, max(1, time_left())))
+        except Exception as e:
+            print(f"Real download failed: {e}")
+        else:
+            challenged = is_challenge_page(response)
+            overloaded = (challenged or response.status_code in OVERLOAD_STATUS_CODES
+                          or time.monotonic() - ticket > UPSTREAM_LATENCY_THRESHOLD)
+        finally:
+            upstream_limiter.release(ticket, overloaded)
+
+        if response is None:
+            # Connection errors and timeouts are worth another try
+            retryable = True
+        elif challenged:
+            print(f"Real download failed: challenge page (HTTP {response.status_code})")
+            retryable = True
+        else:
+            if cached and response.status_code == 304:
+                upstream_breaker.record_success()
+                print(f"Cache revalidated: {url}")
+                meta['fetched_at'] = time.time()
+                page_cache.update_meta(cache_key, meta)
+                return body
+            if response.status_code == 404:
+                # The site is up, this amud just doesn't exist
+                upstream_breaker.record_success()
+                failed_pages.add(cache_key)
+                print(f"Page not found: {url}")
+                return fallback(body)
+            if response.status_code < 400:
+                upstream_breaker.record_success()
+                print(f"SUCCESS: Downloaded {len(response.text)} characters from real site")
+                if response.text != body:
+                    # New or changed content: documents assembled from the old page are stale
+                    result_cache.invalidate_amud(cache_key)
+                page_cache.put(cache_key, response.text, {
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'fetched_at': time.time(),
+                })
+                return response.text
+            print(f"Real download failed: HTTP {response.status_code}")
+            retryable = response.status_code in RETRYABLE_STATUS_CODES
+
+        upstream_breaker.record_failure()
+        if not retryable or attempt == FETCH_RETRIES:
+            break
+        delay = retry_delay(attempt)
+        if delay >= time_left():
+            break
+        print(f"Retrying in {delay:.2f}s: {url}")
+        time.sleep(delay)
+
+    return fallback(body)
+
+class PagesIndex:
+    """(massechet name, daf, side) -> path index of the local pages/ fallback directory.
+
+    Built once and rebuilt only when the directory's mtime changes, so lookups
+    cost a single stat() instead of probing and listing the directory.
+    """
+
+    # Accepted names, in order of preference when several exist for the same amud:
+    # "<name> <daf> ע<side>.html", "<name> <daf> ע"<side>".html", "<name>_<daf>_ע<side>.html"
+    FILENAME_PATTERNS = [
+        re.compile(r'^(.+) (\S+) ע([אב])\.html$'),
+        re.compile(r'^(.+) (\S+) ע"([אב])"\.html$'),
+        re.compile(r'^(.+)_([^_]+)_ע([אב])\.html$'),
+    ]
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = Lock()
+        self.mtime = None
+        self.paths = {}
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            ranked = {}
+            if mtime is not None:
+                for name in os.listdir(self.directory):
+                    for rank, pattern in enumerate(self.FILENAME_PATTERNS):
+                        match = pattern.match(name)
+                        if match:
+                            key = match.groups()
+                            if key not in ranked or rank < ranked[key][0]:
+                                ranked[key] = (rank, os.path.join(self.directory, name))
+                            break
+            self.paths = {key: path for key, (rank, path) in ranked.items()}
+            self.mtime = mtime
+            print(f"DEBUG: Indexed {len(self.paths)} pages in {self.directory}/")
+
+    def lookup(self, massechet_name, daf_hebrew, side):
+        self._refresh()
+        return self.paths.get((massechet_name, daf_hebrew, side))
+
+pages_index = PagesIndex(PAGES_DIR)
+
 def try_load_existing_page(massechet_num, amud_num):
     """Try to load an existing downloaded page from the pages/ directory"""
-    print(f"DEBUG: Looking for massechet_num={massechet_num}, amud_num={amud_num}")
-    
-    # Convert massechet number to name
-    massechet_names = {v: k for k, v in TRACTATES.items()}
-    massechet_name = massechet_names.get(massechet_num, "")
-    print(f"DEBUG: massechet_name = '{massechet_name}'")
-    
+    massechet_name = MASSECHET_NAMES.get(massechet_num, "")
     if not massechet_name:
         print(f"DEBUG: No massechet name found for ID {massechet_num}")
         return None
@@ -219,73 +1517,181 @@ def try_load_existing_page(massechet_num, amud_num):
         side = 'ב'
     
     daf_hebrew = NUMBER_TO_HEBREW.get(daf_num, str(daf_num))
-    print(f"DEBUG: amud_num={amud_num} -> daf_num={daf_num} -> daf_hebrew='{daf_hebrew}' side='{side}'")
-    
-    # Try to find the file in pages/ directory
-    import glob
-    pages_dir = "pages"
-    
-    # Look for files matching the pattern
-    possible_patterns = [
-        f"{massechet_name} {daf_hebrew} ע{side}.html",
-        f"{massechet_name} {daf_hebrew} ע\"{side}\".html", 
-        f"{massechet_name}_{daf_hebrew}_ע{side}.html"
-    ]
     
-    print(f"DEBUG: Looking for patterns: {possible_patterns}")
-    
-    for pattern in possible_patterns:
-        file_path = os.path.join(pages_dir, pattern)
-        print(f"DEBUG: Checking {file_path}")
-        if os.path.exists(file_path):
-            print(f"Found existing file: {file_path}")
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    return f.read()
-            except Exception as e:
-                print(f"Error reading {file_path}: {e}")
-                continue
+    file_path = pages_index.lookup(massechet_name, daf_hebrew, side)
+    if file_path:
+        print(f"Found existing file: {file_path}")
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except Exception as e:
+            print(f"Error reading {file_path}: {e}")
     
     print(f"No existing file found for {massechet_name} {daf_hebrew} ע{side}")
-    
-    # List what files are actually there
-    if os.path.exists(pages_dir):
-        actual_files = [f for f in os.listdir(pages_dir) if massechet_name in f and f.endswith('.html')]
-        print(f"DEBUG: Actual files containing '{massechet_name}': {actual_files}")
-    
     return None
 
 
-def strip_kodat_widget(root):
-    """Remove Kodat.co.il floating widget (scripts, host div, iframes) from a BeautifulSoup subtree."""
+def resolve_html_parser(setting):
+    """Map the DAF_HTML_PARSER setting to an installed BeautifulSoup tree builder"""
+    if setting == 'auto':
+        return 'lxml' if builder_registry.lookup('lxml') else REFERENCE_HTML_PARSER
+    # Check now rather than have every page fail to parse later
+    if builder_registry.lookup(setting) is None:
+        print(f"WARNING: DAF_HTML_PARSER={setting!r} is not an installed parser, using {REFERENCE_HTML_PARSER}")
+        return REFERENCE_HTML_PARSER
+    return setting
+
+HTML_PARSER = resolve_html_parser(HTML_PARSER_SETTING)
+
+class StripRule:
+    """Matcher for junk elements (widgets, ads) to drop from extracted content.
+
+    An element matches when its tag is in `tags` (any tag if None) and `keyword`
+    occurs in one of `attrs` or, with match_text, in its own text.
+    """
+
+    __slots__ = ('keyword', 'tags', 'attrs', 'match_text')
+
+    def __init__(self, keyword, tags=None, attrs=('id', 'class'), match_text=False):
+        self.keyword = keyword.lower()
+        self.tags = frozenset(tags) if tags else None
+        self.attrs = tuple(attrs)
+        self.match_text = match_text
+
+    def matches(self, tag):
+        if self.tags is not None and tag.name not in self.tags:
+            return False
+        for attr in self.attrs:
+            value = tag.attrs.get(attr)
+            if value is None:
+                continue
+            if isinstance(value, list):
+                value = ' '.join(value)
+            if self.keyword in value.lower():
+                return True
+        if self.match_text:
+            return self.keyword in (tag.string or tag.get_text() or '').lower()
+        return False
+
+# Elements removed from every extracted page; add rules here as new junk shows up on the site
+STRIP_RULES = [
+    # Kodat.co.il floating widget: host elements, loader scripts and iframes
+    StripRule('kodat'),
+    StripRule('kodat', tags=['script'], attrs=['src'], match_text=True),
+    StripRule('kodat', tags=['iframe'], attrs=['src']),
+]
+
+def sanitize_fragment(root, rules=STRIP_RULES):
+    """Remove elements matching any strip rule from a BeautifulSoup subtree in a single pass.
+
+    Subtrees of removed elements are not visited.
+    """
     if root is None:
         return
-    kw = 'kodat'
-    for tag in list(root.find_all(True)):
-        if getattr(tag, 'attrs', None) is None:
-            continue
-        tag_id = tag.get('id') or ''
-        if kw in tag_id.lower():
-            tag.decompose()
-            continue
-        if any(kw in str(c).lower() for c in (tag.get('class') or [])):
-            tag.decompose()
-    for script in list(root.find_all('script')):
-        src = (script.get('src') or '').lower()
-        blob = (script.string or script.get_text() or '').lower()
-        if kw in src or kw in blob:
-            script.decompose()
-    for iframe in list(root.find_all('iframe')):
-        if kw in (iframe.get('src') or '').lower():
-            iframe.decompose()
-
-
-def extract_content_and_title(html_content):
+    doomed = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for child in node.contents:
+            if child.name is None:  # text, comments
+                continue
+            if any(rule.matches(child) for rule in rules):
+                doomed.append(child)
+            else:
+                stack.append(child)
+    for tag in doomed:
+        tag.decompose()
+
+
+def extract_processed_layout(soup):
+    """Already processed files (from pages/ directory): the .content div"""
+    return soup.find('div', class_='content')
+
+def extract_steinsaltz_container_layout(soup):
+    """Raw daf-yomi.com pages: the clsBody of the clsContainer with a שטיינזלץ h2"""
+    # Structure: <div class="clsContainer"><h2>שטיינזלץ</h2><div class="clsBody">...</div></div>
+    for container in soup.find_all('div', class_='clsContainer'):
+        h2 = container.find('h2', string=lambda text: text and 'שטיינזלץ' in text)
+        if h2:
+            cls_body = container.find('div', class_='clsBody')
+            if cls_body:
+                return cls_body
+    return None
+
+def extract_text_wrapper_layout(soup):
+    """Raw pages without a Steinsaltz container: ContentPlaceHolderMain_divTextWrapper"""
+    return soup.find('div', id='ContentPlaceHolderMain_divTextWrapper')
+
+def extract_legacy_layout(soup):
+    """Legacy raw pages: the section under a פירוש שטיינזלץ heading"""
+    steinsaltz_heading = soup.find('h2', string=lambda text: text and 'פירוש שטיינזלץ' in text)
+    if not steinsaltz_heading:
+        return None
+    steinsaltz_section = steinsaltz_heading.find_parent()
+    if steinsaltz_section:
+        content_div = steinsaltz_section.find('div')
+        if content_div:
+            steinsaltz_section = content_div
+    
+    # Clean up content
+    if steinsaltz_section:
+        for h1 in steinsaltz_section.find_all('h1'):
+            h1.decompose()
+        for h2 in steinsaltz_section.find_all('h2'):
+            if 'פירוש שטיינזלץ' in h2.get_text():
+                h2.decompose()
+    return steinsaltz_section
+
+def extract_body_layout(soup):
+    """Anything else: the body content minus the h1"""
+    body = soup.find('body')
+    if body:
+        # Remove the h1 to avoid duplication (the title was already read above)
+        title_in_body = body.find('h1')
+        if title_in_body:
+            title_in_body.decompose()
+    return body
+
+# Known page layouts in order of precedence: (name, marker in the raw HTML, strategy).
+# The first layout whose marker appears is the only strategy run; the full chain is
+# only walked when that strategy comes back empty.
+EXTRACTION_LAYOUTS = [
+    ('processed', re.compile(r'class=["\']?content["\'\s>]'), extract_processed_layout),
+    ('steinsaltz_container', re.compile(r'clsContainer'), extract_steinsaltz_container_layout),
+    ('text_wrapper', re.compile(r'ContentPlaceHolderMain_divTextWrapper'), extract_text_wrapper_layout),
+    ('legacy', re.compile(r'פירוש שטיינזלץ'), extract_legacy_layout),
+    ('body', None, extract_body_layout),
+]
+
+# How often each layout won; a jump in "fallback:" entries means the site changed its markup
+layout_counts = {}
+layout_counts_lock = Lock()
+
+def record_layout(name):
+    with layout_counts_lock:
+        layout_counts[name] = layout_counts.get(name, 0) + 1
+
+def detect_layout(html_content):
+    """Pick the extraction layout from cheap markers in the raw HTML"""
+    for layout in EXTRACTION_LAYOUTS:
+        marker = layout[1]
+        if marker is None or marker.search(html_content):
+            return layout
+    return EXTRACTION_LAYOUTS[-1]
+
+def extract_content_and_title(html_content, parser=None):
     """Extract the Hebrew title and content - works with both raw and processed pages"""
+    title, node, layout = extract_content_layout(html_content, parser)
+    if layout:
+        record_layout(layout)
+    return title, node
+
+def extract_content_layout(html_content, parser=None):
+    """Like extract_content_and_title, also returning the name of the layout that matched"""
     if not html_content:
-        return None, None
+        return None, None, None
     
-    soup = BeautifulSoup(html_content, 'html.parser')
+    soup = BeautifulSoup(html_content, parser or HTML_PARSER)
     
     # Extract Hebrew title - prefer the specific page title element from daf-yomi.com
     title_element = soup.find('h1', id='ContentPlaceHolderMain_hdrMassechet2')
@@ -298,67 +1704,24 @@ def extract_content_and_title(html_content):
         title_tag = soup.find('title')
         title = title_tag.get_text().strip() if title_tag else "Unknown"
     
-    def finish(t, node):
-        if node is not None:
-            strip_kodat_widget(node)
-        return t, node
-
-    # For already processed files (from pages/ directory), just get the body content
-    content_div = soup.find('div', class_='content')
-    if content_div:
-        print("DEBUG: Found .content div in processed file")
-        return finish(title, content_div)
-    
-    # For raw files from daf-yomi.com, look for the clsContainer that wraps the Steinsaltz content
-    # Structure: <div class="clsContainer"><h2>שטיינזלץ</h2><div class="clsBody">...</div></div>
-    # Try to find the clsBody directly inside a clsContainer with a שטיינזלץ h2
-    for container in soup.find_all('div', class_='clsContainer'):
-        h2 = container.find('h2', string=lambda text: text and 'שטיינזלץ' in text)
-        if h2:
-            cls_body = container.find('div', class_='clsBody')
-            if cls_body:
-                print("DEBUG: Found שטיינזלץ clsBody in clsContainer")
-                return finish(title, cls_body)
-
-    # Fallback: look for ContentPlaceHolderMain_divTextWrapper
-    text_wrapper = soup.find('div', id='ContentPlaceHolderMain_divTextWrapper')
-    if text_wrapper:
-        print("DEBUG: Found ContentPlaceHolderMain_divTextWrapper")
-        return finish(title, text_wrapper)
+    name, _, strategy = detect_layout(html_content)
+    node = strategy(soup)
+    if node is None:
+        # The marker lied (or the markup changed): try every other layout in order
+        for fallback_name, _, fallback_strategy in EXTRACTION_LAYOUTS:
+            if fallback_name == name:
+                continue
+            node = fallback_strategy(soup)
+            if node is not None:
+                name = f"fallback:{fallback_name}"
+                break
+        else:
+            name = 'none'
+    print(f"DEBUG: Extracted content using {name} layout")
 
-    # Fallback: look for פירוש שטיינזלץ section (legacy format)
-    steinsaltz_heading = soup.find('h2', string=lambda text: text and 'פירוש שטיינזלץ' in text)
-    if steinsaltz_heading:
-        print("DEBUG: Found פירוש שטיינזלץ section in raw file")
-        steinsaltz_section = steinsaltz_heading.find_parent()
-        if steinsaltz_section:
-            content_div = steinsaltz_section.find('div')
-            if content_div:
-                steinsaltz_section = content_div
-        
-        # Clean up content
-        if steinsaltz_section:
-            for h1 in steinsaltz_section.find_all('h1'):
-                h1.decompose()
-            for h2 in steinsaltz_section.find_all('h2'):
-                if 'פירוש שטיינזלץ' in h2.get_text():
-                    h2.decompose()
-        
-        return finish(title, steinsaltz_section)
-    
-    # Fallback: for processed files, just get the body content minus the h1
-    body = soup.find('body')
-    if body:
-        print("DEBUG: Using body content as fallback")
-        # Create a copy and remove the h1 to avoid duplication
-        body_copy = BeautifulSoup(str(body), 'html.parser')
-        title_in_body = body_copy.find('h1')
-        if title_in_body:
-            title_in_body.decompose()
-        return finish(title, body_copy)
-    
-    print("DEBUG: No content found")
-    return title, None
+    if node is not None:
+        sanitize_fragment(node)
+    return title, node, name
 
 def create_html_page(title, content):
     """Create a complete HTML page with the extracted content"""
@@ -393,66 +1756,264 @@ def create_html_page(title, content):
 </html>"""
     return html_template
 
+class Page:
+    """An extracted amud: its title and the cleaned content fragment, serialized once"""
+
+    __slots__ = ('title', 'fragment')
+
+    def __init__(self, title, fragment):
+        self.title = title
+        self.fragment = fragment
+
+def clean_fragment_html(content_html):
+    """Compact the whitespace and paragraph spacing of an extracted content fragment"""
+    # Remove excessive newlines and whitespace
+    content_html = re.sub(r'\n\s*\n+', '\n', content_html)
+    content_html = re.sub(r'<p>\s*</p>', '', content_html)
+    # Remove excessive spacing between paragraphs
+    content_html = re.sub(r'</p>\s*<p>', '</p><p>', content_html)
+    # Minimize margins and padding in paragraphs
+    content_html = re.sub(r'<p>', '<p style="margin:0.2em 0;">', content_html)
+    return content_html.strip()
+
+fragment_cache = DiskCache(os.path.join(CACHE_DIR, 'fragments'), FRAGMENT_CACHE_MAX_BYTES)
+
+@app.before_request
+def start_background_tasks():
+    # Started per process on first use, so it also runs in forked server workers
+    ensure_task_reaper()
+
 @app.route('/')
 def index():
     """Main page with form for selecting tractate and pages"""
     return render_template('index.html', tractates=TRACTATES)
 
+@app.route('/api/stats')
+def upstream_stats():
+    """Current state of the upstream fetch layer, for monitoring"""
+    stats = upstream_limiter.snapshot()
+    stats['circuit_breaker'] = upstream_breaker.state
+    stats['jobs'] = job_scheduler.snapshot()
+    with layout_counts_lock:
+        stats['extraction_layouts'] = dict(layout_counts)
+    return jsonify(stats)
+
 @app.route('/api/progress/<task_id>')
 def progress_stream(task_id):
     """Server-Sent Events endpoint for progress updates"""
     def generate():
-        while task_id in progress_data:
-            data = progress_data[task_id]
+        version = None
+        while True:
+            data, new_version = wait_for_progress(task_id, version, PROGRESS_HEARTBEAT)
+            if data is None:
+                break
+            if new_version == version:
+                # Nothing changed; keep proxies from timing out the idle connection
+                yield ": heartbeat\n\n"
+                continue
+            version = new_version
             yield f"data: {json.dumps(data)}\n\n"
             
             if data.get('status') in ['completed', 'error']:
-                # Clean up completed tasks after sending final update
-                time.sleep(1)
-                if task_id in progress_data:
-                    del progress_data[task_id]
+                # The task itself stays around for TASK_RETENTION_SECONDS
                 break
-                
-            time.sleep(0.5)  # Update every 500ms
     
-    return Response(generate(), mimetype='text/event-stream')
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(generate(), mimetype='text/event-stream', headers=headers)
 
 @app.route('/api/download-file/<task_id>')
 def download_completed_file(task_id):
     """Download the completed file"""
-    if task_id not in progress_data:
+    data = task_store.get(task_id)
+    if data is None:
         return jsonify({'error': 'Task not found'}), 404
     
-    data = progress_data[task_id]
     if data.get('status') != 'completed':
         return jsonify({'error': 'Task not completed'}), 400
     
     file_path = data.get('file_path')
     filename = data.get('filename')
-    temp_dir = data.get('temp_dir')
+    etag = data.get('etag')
     
     if not file_path or not os.path.exists(file_path):
         return jsonify({'error': 'File not found'}), 404
     
-    def cleanup_after_send():
-        """Clean up temporary files after sending"""
+    # Serve the best precompressed variant the client accepts. Every variant has
+    # its own strong ETag, so If-None-Match and Range requests (resumed downloads)
+    # always refer to the exact bytes being sent.
+    encoding = None
+    for name, suffix, _ in DOCUMENT_ENCODINGS:
+        if request.accept_encodings[name] and os.path.exists(file_path + suffix):
+            encoding = name
+            file_path += suffix
+            break
+    
+    response = send_file(
+        file_path,
+        mimetype='text/html',
+        as_attachment=True,
+        download_name=filename,
+        conditional=True,
+        etag=f"{etag}-{encoding or 'identity'}" if etag else True
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/api/stream/<task_id>')
+def stream_task_document(task_id):
+    """Stream the combined document while its pages are still being downloaded.
+
+    The job writes the document in order, so this just follows the output file
+    and forwards whatever has been written, using chunked transfer encoding.
+    """
+    if task_store.get(task_id) is None:
+        return jsonify({'error': 'Task not found'}), 404
+
+    def generate():
+        stream = None
+        streamed = False
+        data, version = wait_for_progress(task_id, None, 0)
         try:
-            if temp_dir and os.path.exists(temp_dir):
-                import shutil
-                shutil.rmtree(temp_dir)
-                print(f"DEBUG: Cleaned up temp dir: {temp_dir}")
-        except Exception as e:
-            print(f"ERROR: Failed to cleanup temp dir: {e}")
-        
-        # Remove from progress_data
-        if task_id in progress_data:
-            del progress_data[task_id]
+            while True:
+                data = data or {}
+                finished = not data or data.get('status') in ('completed', 'error')
+                file_path = data.get('file_path')
+                if stream is None and file_path and os.path.exists(file_path):
+                    stream = open(file_path, 'rb')
+                if stream is not None:
+                    chunk = stream.read(64 * 1024)
+                    if chunk:
+                        streamed = True
+                        yield chunk
+                        continue
+                if finished:
+                    if data.get('status') == 'error':
+                        message = html_lib.escape(data.get('message', ''), quote=False)
+                        if not streamed and data.get('job'):
+                            # The job failed before writing anything: still send a whole document
+                            yield combined_html_header(*data['job'][:5]).encode('utf-8')
+                        yield f'<p class="missing">{message}</p>\n</body>\n</html>'.encode('utf-8')
+                    break
+                # The job bumps the task's progress after every page it writes
+                data, version = wait_for_progress(task_id, version, PROGRESS_HEARTBEAT)
+        finally:
+            if stream is not None:
+                stream.close()
+
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # don't let a reverse proxy hold the chunks back
+    }
+    return Response(generate(), mimetype='text/html', headers=headers)
+
+def parse_range_request(data):
+    """Validate the tractate/range fields of a request.
+
+    Returns ((tractate_name, start_daf, start_amud, end_daf, end_amud, massechet_num), None)
+    or (None, error message).
+    """
+    tractate_name = data.get('tractate')
+    start_daf = data.get('start_daf')
+    start_amud = data.get('start_amud')
+    end_daf = data.get('end_daf')  
+    end_amud = data.get('end_amud')
     
-    # Schedule cleanup after response is sent
-    from threading import Timer
-    Timer(2.0, cleanup_after_send).start()  # Clean up after 2 seconds
+    print(f"DEBUG: tractate='{tractate_name}', start='{start_daf}{start_amud}', end='{end_daf}{end_amud}'")
+    
+    # Validate inputs
+    if not all([tractate_name, start_daf, start_amud, end_daf, end_amud]):
+        print(f"DEBUG: Missing parameters")
+        return None, 'Missing required parameters'
+        
+    # Get tractate ID
+    massechet_num = TRACTATES.get(tractate_name)
+    print(f"DEBUG: Found massechet_num={massechet_num} for '{tractate_name}'")
+    if not massechet_num:
+        return None, f'Unknown tractate: {tractate_name}'
+        
+    # Validate Hebrew page numbers
+    if start_daf not in HEBREW_NUMBERS or end_daf not in HEBREW_NUMBERS:
+        return None, 'Invalid Hebrew page numbers'
+    if start_amud not in ('א', 'ב') or end_amud not in ('א', 'ב'):
+        return None, 'Invalid amud'
     
-    return send_file(file_path, as_attachment=True, download_name=filename)
+    return (tractate_name, start_daf, start_amud, end_daf, end_amud, massechet_num), None
+
+class _ZipStream:
+    """Write-only file object that collects what ZipFile writes so it can be streamed.
+
+    It has no tell() or seek(), so ZipFile writes entries with data descriptors
+    and never needs to go back and patch a header.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+@app.route('/api/export-zip')
+def export_zip():
+    """Stream a ZIP of one HTML file per amud, named like the pages/ directory expects.
+
+    Built on the fly from the page and fragment caches: nothing is written to disk,
+    each file is sent as soon as its amud (and every amud before it) is ready.
+    Query parameters are the same as the fields of /api/download.
+    """
+    params, error = parse_range_request(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+    tractate_name, start_daf, start_amud, end_daf, end_amud, massechet_num = params
+    started = export_slots.acquire()
+    if started is None:
+        retry_after = export_slots.retry_after()
+        response = jsonify({'error': f'Server is busy, please try again in {retry_after} seconds'})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 503
+    amudim = list(iter_amudim(HEBREW_NUMBERS[start_daf], start_amud, HEBREW_NUMBERS[end_daf], end_amud))
+    deadline = time.monotonic() + JOB_DEADLINE
+
+    def fetch(daf_num, amud):
+        if time.monotonic() >= deadline:
+            return None
+        return fetch_amud_page(massechet_num, daf_num, amud, deadline)
+
+    def generate():
+        stream = _ZipStream()
+        missing_pages = []
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for daf_num, amud, page in fetch_pages_in_order(amudim, fetch, deadline):
+                name = f"{tractate_name} {NUMBER_TO_HEBREW[daf_num]} ע{amud}"
+                if page:
+                    archive.writestr(f"{name}.html", create_html_page(page.title, page.fragment))
+                else:
+                    # Placeholders would be mistaken for real pages by the combiners
+                    missing_pages.append(name)
+                yield stream.take()
+            if missing_pages:
+                archive.writestr('missing.txt', '\n'.join(missing_pages) + '\n')
+        yield stream.take()
+
+    filename = create_informative_filename(tractate_name, start_daf, start_amud, end_daf, end_amud)
+    headers = {
+        'Content-Disposition': f"attachment; filename=\"{Path(filename).stem}.zip\"",
+        'X-Accel-Buffering': 'no',
+    }
+    response = Response(generate(), mimetype='application/zip', headers=headers)
+    # Runs when the server is done with the response, even if the body was never read
+    response.call_on_close(lambda: export_slots.release(started))
+    return response
 
 @app.route('/api/download', methods=['POST'])
 def download_pages():
@@ -462,183 +2023,363 @@ def download_pages():
         data = request.json
         print(f"DEBUG: Request data: {data}")
         
-        tractate_name = data.get('tractate')
-        start_daf = data.get('start_daf')
-        start_amud = data.get('start_amud')
-        end_daf = data.get('end_daf')  
-        end_amud = data.get('end_amud')
-        
-        print(f"DEBUG: tractate='{tractate_name}', start='{start_daf}{start_amud}', end='{end_daf}{end_amud}'")
-        
-        # Validate inputs
-        if not all([tractate_name, start_daf, start_amud, end_daf, end_amud]):
-            print(f"DEBUG: Missing parameters")
-            return jsonify({'error': 'Missing required parameters'}), 400
-            
-        # Get tractate ID
-        massechet_num = TRACTATES.get(tractate_name)
-        print(f"DEBUG: Found massechet_num={massechet_num} for '{tractate_name}'")
-        if not massechet_num:
-            return jsonify({'error': f'Unknown tractate: {tractate_name}'}), 400
-            
-        # Validate Hebrew page numbers
-        if start_daf not in HEBREW_NUMBERS or end_daf not in HEBREW_NUMBERS:
-            return jsonify({'error': 'Invalid Hebrew page numbers'}), 400
+        params, error = parse_range_request(data)
+        if error:
+            return jsonify({'error': error}), 400
+        tractate_name, start_daf, start_amud, end_daf, end_amud, massechet_num = params
             
         # Generate unique task ID
         task_id = str(uuid.uuid4())
+        job = [tractate_name, start_daf, start_amud, end_daf, end_amud, massechet_num]
         
-        # Initialize progress data
-        progress_data[task_id] = {
+        # Initialize progress data; the job parameters let another process re-run it.
+        # An identical job that is running or recently finished is shared instead.
+        job_key = result_cache_key(massechet_num, HEBREW_NUMBERS[start_daf], start_amud,
+                                   HEBREW_NUMBERS[end_daf], end_amud)
+        task_id, created = task_store.create_or_join(task_id, {
             'status': 'starting',
             'progress': 0,
             'current_page': '',
             'total_pages': 0,
             'completed_pages': 0,
-            'message': 'מתחיל הורדה...'
-        }
+            'message': 'מתחיל הורדה...',
+            'started_at': time.time(),
+            'job': job
+        }, job, job_key)
+        if not created:
+            print(f"DEBUG: Joining existing task {task_id} for {job_key}")
+            existing = task_store.get(task_id)
+            if existing and existing.get('finished_at'):
+                # Give the new client the full retention period to fetch the file
+                update_progress(task_id, finished_at=time.time())
+            return jsonify({'task_id': task_id, 'deduplicated': True})
+
+        # A cached result needs no worker, so it never waits behind the queue or gets refused
+        filename = create_informative_filename(tractate_name, start_daf, start_amud, end_daf, end_amud)
+        total_pages = sum(1 for _ in iter_amudim(HEBREW_NUMBERS[start_daf], start_amud, HEBREW_NUMBERS[end_daf], end_amud))
+        if complete_from_result_cache(task_id, job_key, filename, total_pages):
+            return jsonify({'task_id': task_id})
         
-        # Start background download task
-        thread = Thread(target=download_pages_background, args=(
-            task_id, tractate_name, start_daf, start_amud, end_daf, end_amud, massechet_num
-        ))
-        thread.daemon = True
-        thread.start()
+        # Queue the download job; refuse it outright when the queue is full
+        if not job_scheduler.submit(task_id, download_pages_background, *job):
+            # Fail the task rather than delete it: an identical request may already have
+            # joined it, and its progress stream should end with this error, not silence
+            update_progress(task_id, status='error', message='השרת עמוס, נסה שוב מאוחר יותר')
+            retry_after = job_scheduler.retry_after()
+            response = jsonify({'error': f'Server is busy, please try again in {retry_after} seconds'})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 503
         
         return jsonify({'task_id': task_id})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def fetch_amud_page(massechet_num, daf_num, amud, deadline=None):
+    """Download and extract a single amud, returning a Page or None"""
+    daf_hebrew = NUMBER_TO_HEBREW[daf_num]
+    amud_number = hebrew_to_amud_number(daf_hebrew, amud)
+    if amud_number == 0:
+        return None
+
+    print(f"DEBUG: Downloading {daf_hebrew} {amud} (amud_number={amud_number})")
+    html_content = download_daf_page(massechet_num, amud_number, deadline)
+    if not html_content:
+        print(f"DEBUG: No html_content for {daf_hebrew} {amud}")
+        return None
+
+    try:
+        page = extract_page(html_content, f"{daf_hebrew} {amud}", deadline)
+    except FutureTimeoutError:
+        # Out of time, not a bad page: don't keep other jobs from parsing it
+        print(f"DEBUG: Ran out of time extracting {daf_hebrew} {amud}")
+        return None
+    if page is None:
+        print(f"DEBUG: Failed to extract title/content from page")
+        failed_pages.add(f"{massechet_num}_{amud_number}")
+    return page
+
+def fragment_cache_key(html_content):
+    """Cache key for a raw page: its content hash plus the extractor version and parser"""
+    digest = hashlib.sha256()
+    digest.update(f"{EXTRACTOR_VERSION}\0{HTML_PARSER}\0".encode('utf-8'))
+    digest.update(html_content.encode('utf-8'))
+    return digest.hexdigest()
+
+def extract_fragment(html_content, label=''):
+    """Parse a raw page into (title, cleaned fragment, layout); safe to run in a worker process"""
+    title, content, layout = extract_content_layout(html_content)
+    if not (title and content):
+        return None, None, layout
+
+    if PARSER_PARITY_CHECK and HTML_PARSER != REFERENCE_HTML_PARSER:
+        check_parser_parity(html_content, title, content, label)
+
+    return title, clean_fragment_html(str(content)), layout
+
+def fragment_text(node):
+    """Whitespace-normalized text of an extracted fragment, for comparing parser backends"""
+    return ' '.join(node.get_text().split()) if node is not None else ''
+
+def check_parser_parity(html_content, title, content, label):
+    """Compare an extraction against the reference parser and log any difference"""
+    # extract_content_layout, not extract_content_and_title: this may run in a parse
+    # worker, and layouts are only counted once, in the web process
+    ref_title, ref_content, _ = extract_content_layout(html_content, REFERENCE_HTML_PARSER)
+    if ref_title != title or fragment_text(ref_content) != fragment_text(content):
+        print(f"WARNING: {HTML_PARSER} and {REFERENCE_HTML_PARSER} extractions differ for {label}")
+        return False
+    return True
+
+parse_pool = None
+parse_pool_lock = Lock()
+
+def get_parse_pool():
+    """Lazily start the shared parsing process pool (None when PARSE_WORKERS is 0)"""
+    global parse_pool
+    if PARSE_WORKERS <= 0:
+        return None
+    with parse_pool_lock:
+        if parse_pool is None:
+            # Forking a process with running threads can copy locks mid-acquire into the
+            # child; start workers from a clean server process instead
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                             mp_context=multiprocessing.get_context(method))
+        return parse_pool
+
+def run_extraction(html_content, label='', deadline=None):
+    """Run extract_fragment in the parse pool if there is one, else in this thread.
+
+    Waiting on the pool stops at `deadline` (a time.monotonic() value) with
+    FutureTimeoutError.
+    """
+    global parse_pool
+    pool = get_parse_pool()
+    if pool is not None:
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+            future = pool.submit(extract_fragment, html_content, label)
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+        except BrokenProcessPool as e:
+            # A crashed worker breaks the whole pool; start a fresh one next time
+            print(f"ERROR: Parse worker failed for {label}: {e}")
+            with parse_pool_lock:
+                if parse_pool is pool:
+                    parse_pool = None
+            pool.shutdown(wait=False)
+    return run_blocking(extract_fragment, html_content, label)
+
+def extract_page(html_content, label='', deadline=None):
+    """Turn a raw page into a Page, reusing a cached extraction of identical content"""
+    cache_key = fragment_cache_key(html_content)
+    cached = fragment_cache.get(cache_key)
+    if cached:
+        fragment, meta = cached
+        print(f"DEBUG: Fragment cache hit for {label}")
+        return Page(meta['title'], fragment)
+
+    title, fragment, layout = run_extraction(html_content, label, deadline)
+    if layout:
+        record_layout(layout)
+    if not (title and fragment):
+        return None
+
+    fragment_cache.put(cache_key, fragment, {'title': title, 'extractor_version': EXTRACTOR_VERSION})
+    return Page(title, fragment)
+
+def result_cache_key(massechet_num, start_num, start_amud, end_num, end_amud):
+    """Result cache key for a range, tied to the output format and extractor versions"""
+    amud_map = {'א': 'a', 'ב': 'b'}
+    return (f"{massechet_num}_{start_num}{amud_map[start_amud]}-{end_num}{amud_map[end_amud]}"
+            f"_v{OUTPUT_FORMAT_VERSION}.{EXTRACTOR_VERSION}")
+
+def create_missing_page(tractate_name, daf_num, amud):
+    """Placeholder page marking an amud that could not be downloaded"""
+    title = f'{tractate_name} {NUMBER_TO_HEBREW[daf_num]} ע"{amud}"'
+    return Page(title, '<p class="missing">⚠️ לא ניתן היה להוריד עמוד זה</p>')
+
+def fetch_pages_in_order(amudim, fetch, deadline):
+    """Yield (daf_num, amud, page) for every amud in order, fetching a few ahead concurrently.
+
+    Only a small window of pages is in flight or waiting to be consumed, so memory
+    stays bounded no matter how long the range is. page is None when the fetch
+    failed or the deadline passed first.
+    """
+    executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    pending = deque()
+    not_submitted = iter(amudim)
+
+    def submit_next():
+        for daf_num, amud in not_submitted:
+            pending.append((daf_num, amud, executor.submit(fetch, daf_num, amud)))
+            break
+
+    try:
+        for _ in range(FETCH_WORKERS * 2):
+            submit_next()
+        while pending:
+            daf_num, amud, future = pending.popleft()
+            try:
+                page = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                print(f"DEBUG: Job deadline passed before {NUMBER_TO_HEBREW[daf_num]} {amud}")
+                future.cancel()
+                page = None
+            submit_next()
+            yield daf_num, amud, page
+    finally:
+        # Also reached when the consumer stops early, e.g. a client disconnecting
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def complete_from_result_cache(task_id, cache_key, filename, total_pages):
+    """Complete a task from the result cache; returns False when there is no usable entry"""
+    cached = result_cache.get_path(cache_key)
+    if not cached or time.time() - cached[1].get('created_at', 0) >= RESULT_CACHE_TTL:
+        return False
+    temp_dir = tempfile.mkdtemp()
+    temp_file = os.path.join(temp_dir, filename)
+    if not result_cache.link_out(cached[0], temp_file):
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return False
+    print(f"DEBUG: Result cache hit for {cache_key}")
+    update_progress(task_id,
+        status='completed',
+        progress=100,
+        total_pages=total_pages,
+        completed_pages=total_pages,
+        message='הושלם! הקובץ מוכן להורדה',
+        missing_pages=[],
+        filename=filename,
+        file_path=temp_file,
+        etag=cached[1].get('etag'),
+        temp_dir=temp_dir
+    )
+    return True
+
 def download_pages_background(task_id, tractate_name, start_daf, start_amud, end_daf, end_amud, massechet_num):
     """Background task to download pages with progress updates"""
     try:
-        # Calculate total number of pages to download
         start_num = HEBREW_NUMBERS[start_daf]
         end_num = HEBREW_NUMBERS[end_daf]
+        amudim = list(iter_amudim(start_num, start_amud, end_num, end_amud))
+        total_pages = len(amudim)
         
-        total_pages = 0
-        for daf_num in range(start_num, end_num + 1):
-            for amud in ['א', 'ב']:
-                # Skip if we're at start daf and before start amud
-                if daf_num == start_num and start_amud == 'ב' and amud == 'א':
-                    continue
-                # Skip if we're at end daf and after end amud  
-                if daf_num == end_num and end_amud == 'א' and amud == 'ב':
-                    continue
-                total_pages += 1
+        filename = create_informative_filename(tractate_name, start_daf, start_amud, end_daf, end_amud)
+        cache_key = result_cache_key(massechet_num, start_num, start_amud, end_num, end_amud)
+        # The result may have been cached while this job waited in the queue
+        if complete_from_result_cache(task_id, cache_key, filename, total_pages):
+            return
         
         # Update progress with total pages
-        progress_data[task_id].update({
-            'total_pages': total_pages,
-            'status': 'downloading',
-            'message': 'מוריד דפים...'
-        })
+        update_progress(task_id,
+            total_pages=total_pages,
+            status='downloading',
+            message='מוריד דפים...'
+        )
             
         # Create a temporary file that persists until explicitly deleted
         temp_dir = tempfile.mkdtemp()
-        pages = []
-        completed_pages = 0
-        
-        # Download pages with progress updates
-        for daf_num in range(start_num, end_num + 1):
-            for amud in ['א', 'ב']:
-                # Skip if we're at start daf and before start amud
-                if daf_num == start_num and start_amud == 'ב' and amud == 'א':
-                    continue
-                # Skip if we're at end daf and after end amud  
-                if daf_num == end_num and end_amud == 'א' and amud == 'ב':
-                    continue
-                    
-                daf_hebrew = NUMBER_TO_HEBREW[daf_num]
-                current_page = f"{daf_hebrew} ע{amud}"
-                
-                # Update progress
-                progress_data[task_id].update({
-                    'current_page': current_page,
-                    'completed_pages': completed_pages,
-                    'progress': int((completed_pages / total_pages) * 100),
-                    'message': f'מוריד דף {current_page}...'
-                })
-                
-                amud_number = hebrew_to_amud_number(daf_hebrew, amud)
-                
-                if amud_number == 0:
-                    completed_pages += 1
-                    continue
-                    
-                # Download the page
-                print(f"DEBUG: Downloading {daf_hebrew} {amud} (amud_number={amud_number})")
-                html_content = download_daf_page(massechet_num, amud_number)
-                
-                if html_content:
-                    title, content = extract_content_and_title(html_content)
-                    
-                    if title and content:
-                        complete_html = create_html_page(title, str(content))
-                        pages.append({'title': title, 'content': complete_html})
-                        print(f"DEBUG: Added page to list, total pages: {len(pages)}")
-                    else:
-                        print(f"DEBUG: Failed to extract title/content from page")
+        temp_file = os.path.join(temp_dir, filename)
+        # Publish the file location now so /api/stream can follow it while it grows
+        update_progress(task_id,
+            filename=filename,
+            file_path=temp_file,
+            temp_dir=temp_dir
+        )
+        written_pages = 0
+        missing_pages = []
+        completed = {'pages': 0}
+        deadline = time.monotonic() + JOB_DEADLINE
+
+        def fetch_with_progress(daf_num, amud):
+            current_page = f"{NUMBER_TO_HEBREW[daf_num]} ע{amud}"
+            update_progress(task_id,
+                current_page=current_page,
+                message=f'מוריד דף {current_page}...'
+            )
+            try:
+                if time.monotonic() >= deadline:
+                    return None
+                return fetch_amud_page(massechet_num, daf_num, amud, deadline)
+            finally:
+                with progress_lock:
+                    completed['pages'] += 1
+                    done = completed['pages']
+                update_progress(task_id,
+                    completed_pages=done,
+                    progress=int((done / total_pages) * 100)
+                )
+
+        # Pages are written to the file in daf/amud order as they finish
+        with open(temp_file, 'w', encoding='utf-8') as out:
+            out.write(combined_html_header(tractate_name, start_daf, start_amud, end_daf, end_amud))
+            out.flush()
+            update_progress(task_id, written_pages=0)
+            for daf_num, amud, page in fetch_pages_in_order(amudim, fetch_with_progress, deadline):
+                if page:
+                    written_pages += 1
                 else:
-                    print(f"DEBUG: No html_content for {daf_hebrew} {amud}")
-                
-                completed_pages += 1
-                
-                # Update progress after each page
-                progress_data[task_id].update({
-                    'completed_pages': completed_pages,
-                    'progress': int((completed_pages / total_pages) * 100)
-                })
+                    missing_pages.append(f"{NUMBER_TO_HEBREW[daf_num]} ע{amud}")
+                    page = create_missing_page(tractate_name, daf_num, amud)
+                out.write(combined_page_html(page))
+                out.flush()
+                update_progress(task_id, written_pages=written_pages + len(missing_pages))
+            out.write(COMBINED_HTML_FOOTER)
         
-        print(f"DEBUG: Final pages count: {len(pages)}")
-        if not pages:
+        print(f"DEBUG: Final pages count: {written_pages}, missing: {missing_pages}")
+        if not written_pages:
+            shutil.rmtree(temp_dir, ignore_errors=True)
             error_msg = f'Unable to download {tractate_name} pages. The daf-yomi.com site appears to be blocking automated requests (likely Cloudflare protection). This affects both the web app and manual scripts. You may need to: 1) Try from a different network, 2) Use a VPN, or 3) Wait for the site restrictions to be lifted.'
-            progress_data[task_id].update({
-                'status': 'error',
-                'message': error_msg
-            })
+            update_progress(task_id,
+                status='error',
+                message=error_msg
+            )
             return
-            
-        # Update progress - creating combined file
-        progress_data[task_id].update({
-            'status': 'processing',
-            'progress': 100,
-            'message': 'יוצר קובץ מאוחד...'
-        })
-            
-        # Create combined HTML
-        combined_html = create_combined_html(pages, tractate_name, start_daf, start_amud, end_daf, end_amud)
         
-        # Save to temporary file with informative name
-        filename = create_informative_filename(tractate_name, start_daf, start_amud, end_daf, end_amud)
-        temp_file = os.path.join(temp_dir, filename)
+        etag = precompress_document(temp_file)
         
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            f.write(combined_html)
+        # Only complete documents are worth serving again
+        if not missing_pages:
+            result_cache.put_file(cache_key, temp_file, {
+                'filename': filename,
+                'etag': etag,
+                'created_at': time.time(),
+                'amudim': [f"{massechet_num}_{hebrew_to_amud_number(NUMBER_TO_HEBREW[daf_num], amud)}"
+                           for daf_num, amud in amudim],
+            })
         
         # Update progress - completed
-        progress_data[task_id].update({
-            'status': 'completed',
-            'progress': 100,
-            'message': 'הושלם! הקובץ מוכן להורדה',
-            'filename': filename,
-            'file_path': temp_file,
-            'temp_dir': temp_dir  # Store temp_dir for cleanup later
-        })
+        if missing_pages:
+            message = f'הושלם חלקית - חסרים {len(missing_pages)} עמודים: {", ".join(missing_pages)}'
+        else:
+            message = 'הושלם! הקובץ מוכן להורדה'
+        update_progress(task_id,
+            status='completed',
+            progress=100,
+            message=message,
+            missing_pages=missing_pages,
+            filename=filename,
+            file_path=temp_file,
+            etag=etag,
+            temp_dir=temp_dir  # Store temp_dir for cleanup later
+        )
             
     except Exception as e:
         print(f"ERROR in background task: {e}")
-        progress_data[task_id].update({
-            'status': 'error',
-            'message': f'שגיאה: {str(e)}'
-        })
+        update_progress(task_id,
+            status='error',
+            message=f'שגיאה: {str(e)}'
+        )
 
-def create_combined_html(pages, tractate_name, start_daf, start_amud, end_daf, end_amud):
-    """Create combined HTML from multiple pages"""
+def combined_html_header(tractate_name, start_daf, start_amud, end_daf, end_amud):
+    """Opening of the combined document, up to where the first page goes"""
     title = f"{tractate_name} {start_daf} {start_amud} - {end_daf} {end_amud}"
     
-    html = f"""<!DOCTYPE html>
+    return f"""<!DOCTYPE html>
 <html dir="rtl" lang="he">
 <head>
     <meta charset="UTF-8">
@@ -673,6 +2414,10 @@ def create_combined_html(pages, tractate_name, start_daf, start_amud, end_daf, e
         .page p {{
             margin: 0.2em 0;
         }}
+        .page .missing {{
+            color: #b22222;
+            font-weight: bold;
+        }}
         @media print {{
             .page {{
                 border-bottom: none;
@@ -683,55 +2428,20 @@ def create_combined_html(pages, tractate_name, start_daf, start_amud, end_daf, e
 <body>
     <h1>📖 {title}</h1>
 """
-    
-    for page in pages:
-        soup = BeautifulSoup(page['content'], 'html.parser')
-        
-        # Extract title and content properly
-        page_title = soup.find('h1')
-        page_content = soup.find('body')
-        
-        html += f'<div class="page">\n'
-        
-        if page_title:
-            html += f'<h1>{page_title.get_text().strip()}</h1>\n'
-            
-        if page_content:
-            # Remove the h1 from content to avoid duplication
-            content_copy = BeautifulSoup(str(page_content), 'html.parser')
-            strip_kodat_widget(content_copy)
-            title_in_content = content_copy.find('h1')
-            if title_in_content:
-                title_in_content.decompose()
-            
-            # Extract just the content div to avoid extra body/html structure
-            content_div = content_copy.find('div', class_='content')
-            if content_div:
-                # More aggressive whitespace cleanup
-                content_html = str(content_div)
-                # Remove excessive newlines and whitespace
-                content_html = re.sub(r'\n\s*\n+', '\n', content_html)
-                content_html = re.sub(r'<p>\s*</p>', '', content_html)
-                # Remove excessive spacing between paragraphs
-                content_html = re.sub(r'</p>\s*<p>', '</p><p>', content_html)
-                # Minimize margins and padding in paragraphs
-                content_html = re.sub(r'<p>', '<p style="margin:0.2em 0;">', content_html)
-                html += content_html
-            else:
-                # Fallback: use the body content but clean it up
-                content_html = str(content_copy)
-                content_html = re.sub(r'\n\s*\n+', '\n', content_html)
-                content_html = re.sub(r'<p>\s*</p>', '', content_html)
-                content_html = re.sub(r'</p>\s*<p>', '</p><p>', content_html)
-                content_html = re.sub(r'<p>', '<p style="margin:0.2em 0;">', content_html)
-                html += content_html
-            
-        html += '</div>\n\n'
-    
-    html += """</body>
+
+def combined_page_html(page):
+    """HTML chunk for one page of the combined document"""
+    return (f'<div class="page">\n<h1>{html_lib.escape(page.title, quote=False)}</h1>\n'
+            f'<div class="content">\n{page.fragment}\n</div>'
+            '</div>\n\n')
+
+COMBINED_HTML_FOOTER = """</body>
 </html>"""
-    
-    return html
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
+    if SERVER_MODE == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        print("DEBUG: Serving with gevent on port 5001")
+        WSGIServer(('0.0.0.0', 5001), app).serve_forever()
+    else:
+        app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
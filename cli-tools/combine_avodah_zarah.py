@@ -1,5 +1,6 @@
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from bs4 import BeautifulSoup
 
@@ -9,6 +10,9 @@ pages_dir = Path("pages")
 # Output file path
 output_file = Path("avodah_zarah_46-53.html")
 
+# Processes used to parse pages in parallel (0 parses everything in this process)
+PARSE_WORKERS = int(os.environ.get('DAF_PARSE_WORKERS', '0'))
+
 # Hebrew to number mapping for sorting
 hebrew_numbers = {
     'ב': 2, 'ג': 3, 'ד': 4, 'ה': 5, 'ו': 6, 'ז': 7, 'ח': 8, 'ט': 9, 'י': 10,
@@ -30,41 +34,94 @@ def get_sorting_key(filename):
         return (tractate, page_num, side_num)
     return (filename, 0, 0)
 
+def render_page(i, filename):
+    """Parse one page file and return its HTML chunk for the combined document"""
+    # Read and parse the HTML file
+    with open(pages_dir / filename, "r", encoding="utf-8") as file:
+        content = file.read()
+    
+    # Parse HTML to extract body content
+    soup = BeautifulSoup(content, 'html.parser')
+    
+    # Extract the h1 title and the content div
+    h1_tag = soup.find('h1')
+    content_div = soup.find('div', class_='content')
+    
+    # Add page break class for print only on certain pages (every 2 pages)
+    page_break_class = ' page-break' if i > 0 and i % 2 == 0 else ''
+    
+    # Write page title as a compact marker
+    chunk = ''
+    if h1_tag:
+        title_text = h1_tag.get_text()
+        chunk += f'<div class="page-marker{page_break_class}">{title_text}</div>\n'
+    
+    # Write the content
+    chunk += '<div class="page-content">\n'
+    if content_div:
+        # Remove any internal h1, h2 tags to save space
+        for tag in content_div.find_all(['h1', 'h2', 'h3']):
+            tag.name = 'strong'
+            tag.wrap(soup.new_tag('p'))
+        
+        # Clean up any nested divs that might cause extra spacing
+        for div in content_div.find_all('div'):
+            div.name = 'span'
+        
+        chunk += str(content_div) + '\n'
+    else:
+        # Fallback: write the entire body content if no content div found
+        body = soup.find('body')
+        if body:
+            for tag in body.find_all(['h1', 'h2', 'h3']):
+                tag.name = 'strong'
+                tag.wrap(soup.new_tag('p'))
+            
+            for div in body.find_all('div'):
+                if not div.get('class') or 'content' not in div.get('class'):
+                    div.name = 'span'
+            
+            chunk += ''.join(str(child) for child in body.children)
+    
+    chunk += '</div>\n\n'
+    return chunk
+
 # Define the range we want to include
 start_daf = 'מו'
 start_amud = 'א'
 end_daf = 'נג'
 end_amud = 'ב'
 
-# Get all HTML files
-all_files = [f for f in os.listdir(pages_dir) if f.endswith(".html")]
-filtered_files = []
+if __name__ == "__main__":
+    # Get all HTML files
+    all_files = [f for f in os.listdir(pages_dir) if f.endswith(".html")]
+    filtered_files = []
 
-# Filter files to include only the desired range
-for filename in all_files:
-    match = re.search(r'עבודה זרה\s+([^\s]+)\s+(עא|עב)\.html$', filename)
-    if match:
-        daf_hebrew, amud = match.groups()
-        daf_num = hebrew_numbers.get(daf_hebrew, 0)
-        start_num = hebrew_numbers.get(start_daf, 0)
-        end_num = hebrew_numbers.get(end_daf, 0)
+    # Filter files to include only the desired range
+    for filename in all_files:
+        match = re.search(r'עבודה זרה\s+([^\s]+)\s+(עא|עב)\.html$', filename)
+        if match:
+            daf_hebrew, amud = match.groups()
+            daf_num = hebrew_numbers.get(daf_hebrew, 0)
+            start_num = hebrew_numbers.get(start_daf, 0)
+            end_num = hebrew_numbers.get(end_daf, 0)
         
-        # Check if file is within range
-        if start_num <= daf_num <= end_num:
-            # Check for edge cases at start and end
-            if daf_num == start_num and amud == 'עא' and start_amud == 'ב':
-                continue
-            if daf_num == end_num and amud == 'עב' and end_amud == 'א':
-                continue
-            filtered_files.append(filename)
+            # Check if file is within range
+            if start_num <= daf_num <= end_num:
+                # Check for edge cases at start and end
+                if daf_num == start_num and amud == 'עא' and start_amud == 'ב':
+                    continue
+                if daf_num == end_num and amud == 'עב' and end_amud == 'א':
+                    continue
+                filtered_files.append(filename)
 
-# Sort files by tractate, page number, and side
-filtered_files.sort(key=get_sorting_key)
+    # Sort files by tractate, page number, and side
+    filtered_files.sort(key=get_sorting_key)
 
-# Create the combined HTML file with RTL support
-with open(output_file, "w", encoding="utf-8") as out_file:
-    # Write HTML header with RTL direction
-    out_file.write("""<!DOCTYPE html>
+    # Create the combined HTML file with RTL support
+    with open(output_file, "w", encoding="utf-8") as out_file:
+        # Write HTML header with RTL direction
+        out_file.write("""<!DOCTYPE html>
 <html lang="he" dir="rtl">
 <head>
     <meta charset="UTF-8">
@@ -126,64 +183,24 @@ with open(output_file, "w", encoding="utf-8") as out_file:
 <h1 class="main-title">עבודה זרה דף מו עמוד א - דף נג עמוד ב</h1>
 """)
 
-    # Process each file and append to the combined document
-    for i, filename in enumerate(filtered_files):
-        # Read and parse the HTML file
-        with open(pages_dir / filename, "r", encoding="utf-8") as file:
-            content = file.read()
-        
-        # Parse HTML to extract body content
-        soup = BeautifulSoup(content, 'html.parser')
-        
-        # Extract the h1 title and the content div
-        h1_tag = soup.find('h1')
-        content_div = soup.find('div', class_='content')
-        
-        # Add page break class for print only on certain pages (every 2 pages)
-        page_break_class = ' page-break' if i > 0 and i % 2 == 0 else ''
-        
-        # Write page title as a compact marker
-        if h1_tag:
-            title_text = h1_tag.get_text()
-            out_file.write(f'<div class="page-marker{page_break_class}">{title_text}</div>\n')
-        
-        # Write the content
-        out_file.write('<div class="page-content">\n')
-        if content_div:
-            # Remove any internal h1, h2 tags to save space
-            for tag in content_div.find_all(['h1', 'h2', 'h3']):
-                tag.name = 'strong'
-                tag.wrap(soup.new_tag('p'))
-            
-            # Clean up any nested divs that might cause extra spacing
-            for div in content_div.find_all('div'):
-                div.name = 'span'
-            
-            out_file.write(str(content_div) + '\n')
+        # Parse pages (in parallel when PARSE_WORKERS is set) and append them in order
+        indexes = range(len(filtered_files))
+        if PARSE_WORKERS > 0:
+            with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+                chunks = pool.map(render_page, indexes, filtered_files)
         else:
-            # Fallback: write the entire body content if no content div found
-            body = soup.find('body')
-            if body:
-                for tag in body.find_all(['h1', 'h2', 'h3']):
-                    tag.name = 'strong'
-                    tag.wrap(soup.new_tag('p'))
-                
-                for div in body.find_all('div'):
-                    if not div.get('class') or 'content' not in div.get('class'):
-                        div.name = 'span'
-                
-                out_file.write(''.join(str(child) for child in body.children))
-        
-        out_file.write('</div>\n\n')
+            chunks = map(render_page, indexes, filtered_files)
+        for i, chunk in enumerate(chunks):
+            out_file.write(chunk)
         
-        # Add a subtle separator between pages except for the last page
-        if i < len(filtered_files) - 1:
-            out_file.write('<div class="separator"></div>\n\n')
+            # Add a subtle separator between pages except for the last page
+            if i < len(filtered_files) - 1:
+                out_file.write('<div class="separator"></div>\n\n')
     
-    # Close the HTML document
-    out_file.write("""</body>
+        # Close the HTML document
+        out_file.write("""</body>
 </html>
 """)
 
-print(f"Successfully combined {len(filtered_files)} files into {output_file}")
-print(f"Files processed in order: {', '.join(filtered_files)}") 
\ No newline at end of file
+    print(f"Successfully combined {len(filtered_files)} files into {output_file}")
+    print(f"Files processed in order: {', '.join(filtered_files)}") 
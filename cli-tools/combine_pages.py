@@ -1,5 +1,6 @@
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from bs4 import BeautifulSoup
 
@@ -9,6 +10,9 @@ pages_dir = Path("pages")
 # Output file path
 output_file = Path("combined_pages.html")
 
+# Processes used to parse pages in parallel (0 parses everything in this process)
+PARSE_WORKERS = int(os.environ.get('DAF_PARSE_WORKERS', '0'))
+
 # Hebrew to number mapping for sorting
 hebrew_numbers = {
     'ב': 2, 'ג': 3, 'ד': 4, 'ה': 5, 'ו': 6, 'ז': 7, 'ח': 8, 'ט': 9, 'י': 10,
@@ -42,16 +46,49 @@ def get_sorting_key(filename):
         return (tractate, page_num, side_num)
     return (filename, 0, 0)
 
-# Get all HTML files
-html_files = [f for f in os.listdir(pages_dir) if f.endswith(".html")]
+def render_page(filename):
+    """Parse one page file and return its HTML chunk for the combined document"""
+    # Read and parse the HTML file
+    with open(pages_dir / filename, "r", encoding="utf-8") as file:
+        content = file.read()
+    
+    # Parse HTML to extract body content
+    soup = BeautifulSoup(content, 'html.parser')
+    
+    # Extract the h1 title and the content div
+    h1_tag = soup.find('h1')
+    content_div = soup.find('div', class_='content')
+    
+    # Write page with content
+    chunk = '<div class="page">\n'
+    
+    # Write the h1 if found
+    if h1_tag:
+        chunk += str(h1_tag) + '\n'
+    
+    # Write the content
+    if content_div:
+        chunk += str(content_div) + '\n'
+    else:
+        # Fallback: write the entire body content if no content div found
+        body = soup.find('body')
+        if body:
+            chunk += ''.join(str(child) for child in body.children)
+    
+    chunk += '</div>\n\n'
+    return chunk
+
+if __name__ == "__main__":
+    # Get all HTML files
+    html_files = [f for f in os.listdir(pages_dir) if f.endswith(".html")]
 
-# Sort files by tractate, page number, and side
-html_files.sort(key=get_sorting_key)
+    # Sort files by tractate, page number, and side
+    html_files.sort(key=get_sorting_key)
 
-# Create the combined HTML file with RTL support
-with open(output_file, "w", encoding="utf-8") as out_file:
-    # Write HTML header with RTL direction
-    out_file.write("""<!DOCTYPE html>
+    # Create the combined HTML file with RTL support
+    with open(output_file, "w", encoding="utf-8") as out_file:
+        # Write HTML header with RTL direction
+        out_file.write("""<!DOCTYPE html>
 <html lang="he" dir="rtl">
 <head>
     <meta charset="UTF-8">
@@ -97,41 +134,19 @@ with open(output_file, "w", encoding="utf-8") as out_file:
 <body>
 """)
 
-    # Process each file and append to the combined document
-    for i, filename in enumerate(html_files):
-        # Read and parse the HTML file
-        with open(pages_dir / filename, "r", encoding="utf-8") as file:
-            content = file.read()
-        
-        # Parse HTML to extract body content
-        soup = BeautifulSoup(content, 'html.parser')
-        
-        # Extract the h1 title and the content div
-        h1_tag = soup.find('h1')
-        content_div = soup.find('div', class_='content')
-        
-        # Write page with content
-        out_file.write(f'<div class="page">\n')
-        
-        # Write the h1 if found
-        if h1_tag:
-            out_file.write(str(h1_tag) + '\n')
-        
-        # Write the content
-        if content_div:
-            out_file.write(str(content_div) + '\n')
+        # Parse pages (in parallel when PARSE_WORKERS is set) and append them in order
+        if PARSE_WORKERS > 0:
+            with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+                for chunk in pool.map(render_page, html_files):
+                    out_file.write(chunk)
         else:
-            # Fallback: write the entire body content if no content div found
-            body = soup.find('body')
-            if body:
-                out_file.write(''.join(str(child) for child in body.children))
-        
-        out_file.write('</div>\n\n')
+            for filename in html_files:
+                out_file.write(render_page(filename))
     
-    # Close the HTML document
-    out_file.write("""</body>
+        # Close the HTML document
+        out_file.write("""</body>
 </html>
 """)
 
-print(f"Successfully combined {len(html_files)} files into {output_file}")
-print(f"Files processed in order: {', '.join(html_files)}") 
\ No newline at end of file
+    print(f"Successfully combined {len(html_files)} files into {output_file}")
+    print(f"Files processed in order: {', '.join(html_files)}") 
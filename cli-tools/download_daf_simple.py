@@ -8,8 +8,45 @@ from curl_cffi import requests
 import os
 import re
 import time
+from threading import Lock
 from bs4 import BeautifulSoup
 
+# Politeness towards daf-yomi.com: requests per second and burst size. A single CLI
+# run is slower than the web app's shared budget (DAF_UPSTREAM_*), hence its own settings.
+UPSTREAM_RATE = float(os.environ.get('DAF_CLI_RATE', '0.5'))
+UPSTREAM_BURST = max(1, int(os.environ.get('DAF_CLI_BURST', '1')))
+
+# Same as app.TokenBucket; copied so this script runs without the web app's dependencies
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a request may be sent"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+rate_limiter = TokenBucket(UPSTREAM_RATE, UPSTREAM_BURST)
+
+# One persistent session so every amud reuses the same connection
+# (Chrome 120 impersonation bypasses Cloudflare)
+session = requests.Session(impersonate='chrome120')
+
 def hebrew_to_amud_number(daf_hebrew, amud):
     """Convert Hebrew daf notation to amud number used by the site"""
     # Mapping Hebrew letters to numbers
@@ -48,11 +85,10 @@ def download_daf_page(massechet_num, amud_num):
     url = f"https://daf-yomi.com/Dafyomi_Page.aspx?vt=5&massechet={massechet_num}&amud={amud_num}&fs=0"
 
     try:
-        # Add small delay to be respectful
-        time.sleep(2)
+        # Be respectful: stay within the configured request rate
+        rate_limiter.acquire()
 
-        # Use curl_cffi with Chrome 120 impersonation (bypasses Cloudflare)
-        response = requests.get(url, impersonate='chrome120', timeout=30)
+        response = session.get(url, timeout=30)
         response.raise_for_status()
         return response.text
     except Exception as e:
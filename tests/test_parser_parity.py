@@ -0,0 +1,67 @@
+"""lxml must extract the same title and text as the reference html.parser.
+
+Each file in tests/pages is a saved page of one of the layouts app.py knows about.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+pytest.importorskip('lxml')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pages')
+
+# Keep the app's disk caches out of the working tree
+os.environ.setdefault('DAF_CACHE_DIR', tempfile.mkdtemp(prefix='daf-test-cache-'))
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+LAYOUT_PAGES = [
+    ('processed.html', 'processed'),
+    ('steinsaltz_container.html', 'steinsaltz_container'),
+    ('text_wrapper.html', 'text_wrapper'),
+    ('legacy.html', 'legacy'),
+]
+
+
+def read_page(name):
+    with open(os.path.join(PAGES, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('name, layout', LAYOUT_PAGES)
+def test_page_matches_its_layout(name, layout):
+    html = read_page(name)
+    assert app.detect_layout(html)[0] == layout
+    for parser in ('html.parser', 'lxml'):
+        assert app.extract_content_layout(html, parser)[2] == layout
+
+
+@pytest.mark.parametrize('name, layout', LAYOUT_PAGES)
+def test_lxml_matches_reference_parser(name, layout):
+    html = read_page(name)
+    ref_title, ref_node, _ = app.extract_content_layout(html, app.REFERENCE_HTML_PARSER)
+    title, node, _ = app.extract_content_layout(html, 'lxml')
+
+    assert ref_title and ref_node is not None
+    assert title == ref_title
+    assert app.fragment_text(node) == app.fragment_text(ref_node)
+    assert app.check_parser_parity(html, title, node, name)
+
+
+def test_kodat_widget_is_stripped_by_both_parsers():
+    html = read_page('steinsaltz_container.html')
+    for parser in ('html.parser', 'lxml'):
+        _, node, _ = app.extract_content_layout(html, parser)
+        assert 'kodat' not in str(node)
+        assert 'פרסומת' not in app.fragment_text(node)
+
+
+def test_unknown_parser_setting_falls_back_to_reference():
+    assert app.resolve_html_parser('no-such-parser') == app.REFERENCE_HTML_PARSER
+    assert app.resolve_html_parser('lxml') == 'lxml'
+    assert app.resolve_html_parser('auto') == 'lxml'